@@ -0,0 +1,259 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import uproot
+import uproot_methods
+import physt
+import ftool
+import ftool.methods
+
+
+def legacy_from_physt(histogram):
+    """ the per bin conversion ftool.methods.from_physt used to do """
+    import physt.binnings
+
+    class TH1(uproot_methods.classes.TH1.Methods, list):
+        pass
+
+    class TAxis(object):
+        def __init__(self, fNbins, fXmin, fXmax):
+            self._fNbins = fNbins
+            self._fXmin = fXmin
+            self._fXmax = fXmax
+
+    out = TH1.__new__(TH1)
+    out._fXaxis = TAxis(histogram.binning.bin_count,
+                        histogram.binning.first_edge,
+                        histogram.binning.last_edge)
+    if isinstance(histogram.binning, physt.binnings.NumpyBinning):
+        out._fXaxis._fXbins = histogram.binning.numpy_bins.astype(">f8")
+
+    centers = histogram.bin_centers
+    content = histogram.frequencies
+
+    out._fSumw2 = [0] + list(histogram.errors2) + [0]
+
+    mean = histogram.mean()
+    variance = histogram.variance()
+    out._fEntries = content.sum()
+    out._fTsumw = content.sum()
+    out._fTsumw2 = histogram.errors2.sum()
+    if mean is None:
+        out._fTsumwx = (content * centers).sum()
+    else:
+        out._fTsumwx = mean * out._fTsumw
+    if mean is None or variance is None:
+        out._fTsumwx2 = (content * centers**2).sum()
+    else:
+        out._fTsumwx2 = (mean**2 + variance) * out._fTsumw2
+
+    out._fTitle = histogram.name if histogram.name is not None else b""
+    out._classname, content = uproot_methods.classes.TH1._histtype(content)
+
+    valuesarray = np.empty(len(content) + 2, dtype=content.dtype)
+    valuesarray[1:-1] = content
+    valuesarray[0] = histogram.underflow
+    valuesarray[-1] = histogram.overflow
+    out.extend(valuesarray)
+    return out
+
+
+def timeit(function, repeat):
+    """ best time of repeat calls, in seconds """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def make_histograms(nbins, count):
+    rng = np.random.RandomState(42)
+    edges = np.linspace(0, 1000, nbins + 1)
+    histograms = []
+    for i in range(count):
+        content = rng.exponential(10, nbins)
+        histograms.append(physt.histogram1d.Histogram1D(
+            physt.binnings.NumpyBinning(edges), content,
+            errors2=content * 0.1, name="h{}".format(i)
+        ))
+    return histograms
+
+
+def bench_convert(options):
+    print("{:>8} {:>12} {:>12} {:>8} {:>12} {:>12} {:>8}".format(
+        "bins", "legacy [ms]", "new [ms]", "speedup",
+        "legacy+w [ms]", "new+w [ms]", "speedup"
+    ))
+    tmpdir = tempfile.mkdtemp()
+    for nbins in options.bins:
+        histograms = make_histograms(nbins, options.histograms)
+
+        def convert(function):
+            return lambda: [function(h) for h in histograms]
+
+        def write(function):
+            def run():
+                with uproot.recreate(os.path.join(tmpdir, "bench.root")) as fout:
+                    fout.update((h.name, function(h)) for h in histograms)
+            return run
+
+        legacy = timeit(convert(legacy_from_physt), options.repeat)
+        new    = timeit(convert(ftool.methods.from_physt), options.repeat)
+        legacy_write = timeit(write(legacy_from_physt), options.repeat)
+        new_write    = timeit(write(ftool.methods.from_physt), options.repeat)
+        print("{:>8} {:>12.2f} {:>12.2f} {:>8.1f} {:>12.2f} {:>12.2f} {:>8.1f}".format(
+            nbins, legacy * 1e3, new * 1e3, legacy / new,
+            legacy_write * 1e3, new_write * 1e3, legacy_write / new_write
+        ))
+
+
+def make_card(outdir, compression, nbins, nuisances):
+    """ a card with one process and nuisances shape variations """
+    rng = np.random.RandomState(42)
+    edges = np.linspace(0, 1000, nbins + 1)
+    content = rng.exponential(10, nbins)
+    nominal = physt.histogram1d.Histogram1D(
+        physt.binnings.NumpyBinning(edges), content, errors2=content * 0.1
+    )
+    cwd = os.getcwd()
+    os.chdir(outdir)
+    try:
+        card = ftool.datacard("bench", "ch1", compression=compression)
+        card.shapes_headers()
+        card.add_observation(nominal)
+        card.add_nominal("bkg", nominal)
+        card.add_templates({
+            "bkg_shape{}{}".format(i, direction): (
+                content * rng.normal(1, 0.05, nbins), content * 0.1
+            )
+            for i in range(nuisances) for direction in ["Up", "Down"]
+        })
+        for i in range(nuisances):
+            card.add_nuisance("bkg", "{:<20} shape".format("shape{}".format(i)), 1.0)
+        start = time.perf_counter()
+        card.dump()
+        elapsed = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+    return os.path.join(outdir, card.dc_name), elapsed
+
+
+def bench_write(options):
+    text2workspace = shutil.which("text2workspace.py")
+    print("{:>10} {:>12} {:>12} {:>12} {:>16}".format(
+        "setting", "write [ms]", "size [kB]", "read [ms]", "t2w [s]"
+    ))
+    for spec in options.compression:
+        outdir = tempfile.mkdtemp()
+        dc_name, write = make_card(
+            outdir, ftool.compression(spec), options.bins, options.nuisances
+        )
+        shape_name = dc_name.replace(".dat", ".root")
+
+        def read():
+            ufile = uproot.open(shape_name)
+            for name in ufile.keys():
+                ufile[name].allvalues
+        read_time = timeit(read, options.repeat)
+
+        t2w = "-"
+        if text2workspace is not None:
+            start = time.perf_counter()
+            subprocess.check_call(
+                [text2workspace, os.path.basename(dc_name), "-o", "ws.root"],
+                cwd=os.path.dirname(dc_name),
+                stdout=subprocess.DEVNULL
+            )
+            t2w = "{:.2f}".format(time.perf_counter() - start)
+        print("{:>10} {:>12.1f} {:>12.1f} {:>12.1f} {:>16}".format(
+            spec, write * 1e3, os.path.getsize(shape_name) / 1024.,
+            read_time * 1e3, t2w
+        ))
+        shutil.rmtree(outdir)
+
+
+def write_counting_card(fn, channel, processes, nuisances):
+    """ a single bin card laid out like the fitroom/card_* ones """
+    lines = [
+        "imax 1", "jmax {}".format(len(processes) - 1), "kmax {}".format(nuisances),
+        "-" * 30,
+        "bin          {}".format(channel),
+        "observation  10.000",
+        "-" * 30,
+        "bin      " + "".join("{:>20}".format(channel) for _ in processes),
+        "process  " + "".join("{:>20}".format(p) for p in processes),
+        "process  " + "".join("{:>20}".format(i) for i in range(len(processes))),
+        "rate     " + "".join("{:>20}".format("1.000") for _ in processes),
+        "-" * 30,
+    ]
+    lines += [
+        "nuisance{} lnN ".format(i) + "".join("{:>20}".format("0.900/1.100") for _ in processes)
+        for i in range(nuisances)
+    ]
+    lines.append("norm rateParam {} {} 1 [0.01,10]".format(channel, processes[-1]))
+    with open(fn, "w") as fout:
+        fout.write("\n".join(lines) + "\n")
+
+
+def bench_combine(options):
+    processes = ["Signal"] + ["bkg{}".format(i) for i in range(options.processes - 1)]
+    print("{:>8} ".format("bins") + " ".join("{:>20}".format(os.path.basename(s)) for s in options.scripts))
+    for nbins in options.bins:
+        tmpdir = tempfile.mkdtemp()
+        cards = []
+        for ibin in range(nbins):
+            channel = "bin{}".format(ibin)
+            fn = os.path.join(tmpdir, "card_{}.txt".format(channel))
+            write_counting_card(fn, channel, processes, options.nuisances)
+            cards.append("{}={}".format(channel, fn))
+        times = []
+        for script in options.scripts:
+            start = time.perf_counter()
+            subprocess.check_call(
+                ["python3", script, "--no-cache"] + cards, stdout=subprocess.DEVNULL
+            )
+            times.append(time.perf_counter() - start)
+        print("{:>8} ".format(nbins) + " ".join("{:>18.2f} s".format(t) for t in times))
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='micro-benchmarks of ftool')
+    commands = parser.add_subparsers(dest="command")
+
+    convert = commands.add_parser("convert")
+    convert.add_argument("-b", "--bins"      , nargs='+', type=int, default=[10, 100, 1000, 10000])
+    convert.add_argument("-n", "--histograms", type=int, default=200)
+    convert.add_argument("-r", "--repeat"    , type=int, default=5)
+    convert.set_defaults(function=bench_convert)
+
+    write = commands.add_parser("write")
+    write.add_argument("-c", "--compression", nargs='+', type=str,
+                       default=["none", "zlib:1", "zlib:4", "zlib:9", "lzma:4", "lz4:4"])
+    write.add_argument("-b", "--bins"      , type=int, default=50)
+    write.add_argument("-n", "--nuisances" , type=int, default=200)
+    write.add_argument("-r", "--repeat"    , type=int, default=3)
+    write.set_defaults(function=bench_write)
+
+    combine = commands.add_parser("combine")
+    combine.add_argument("-b", "--bins"     , nargs='+', type=int, default=[10, 100, 1000, 10000])
+    combine.add_argument("-p", "--processes", type=int, default=6)
+    combine.add_argument("-n", "--nuisances", type=int, default=9)
+    combine.add_argument("-s", "--scripts"  , nargs='+', type=str,
+                         default=[os.path.join(os.path.dirname(os.path.abspath(__file__)), "combineCards.py")])
+    combine.set_defaults(function=bench_combine)
+
+    options = parser.parse_args()
+    if options.command is None:
+        parser.error("a benchmark is needed")
+    options.function(options)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,17 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import re
+import sys
 from sys import argv, exit
+import os
 import os.path
+import hashlib
+import multiprocessing
+import concurrent.futures
 from pprint import pprint
 from optparse import OptionParser
-import six
 from six.moves import range
+import ftool.cache
 
 parser = OptionParser(
     usage="%prog [options] [label=datacard.txt | datacard.txt]",
@@ -71,6 +76,43 @@ parser.add_option(
     help="edit the nuisances in this file",
 )
 
+parser.add_option(
+    "--combine-parser",
+    dest="combineParser",
+    default=False,
+    action="store_true",
+    help="Read the datacards with the parser of combine instead of the one of ftool, for syntax ftool does not write",
+)
+parser.add_option(
+    "-j",
+    "--jobs",
+    type="int",
+    dest="jobs",
+    default=1,
+    help="Parse the input datacards in this many processes (default: no extra process, combinations are often run side by side already)",
+)
+parser.add_option(
+    "--cache-dir",
+    type="string",
+    dest="cacheDir",
+    default=os.path.join(ftool.cache.default_dir(), "cards"),
+    help="Keep the parsed datacards in this directory, keyed by their content",
+)
+parser.add_option(
+    "--no-cache",
+    dest="noCache",
+    default=False,
+    action="store_true",
+    help="Parse all the datacards again and do not store them",
+)
+parser.add_option(
+    "--tree",
+    type="int",
+    dest="tree",
+    default=0,
+    help="Combine the datacards in groups of this many in parallel processes, then merge the groups two by two",
+)
+
 (options, args) = parser.parse_args()
 options.bin = True  # fake that is a binary output, so that we parse shape lines
 options.nuisancesToExclude = []
@@ -83,334 +125,128 @@ if options.nuisVetoFile:
     for line in open(options.nuisVetoFile, "r"):
         options.nuisancesToExclude.append(re.compile(line.strip()))
 
-import combine
-from combine.DatacardParser import *
+if options.combineParser:
+    import combine
+    from combine.DatacardParser import *
+else:
+    from ftool.cardparser import parse as parseCard
+from ftool.combination import Combination
+
+# bump this whenever the parsed datacards change, e.g. with a new combine
+CARD_CACHE_VERSION = 1
+
+parseOptions = dict(
+    bin=options.bin,
+    noJMax=options.noJMax,
+    allowNoSignal=options.allowNoSignal,
+    allowNoBackground=options.allowNoBackground,
+    evaluateEdits=options.evaluateEdits,
+    nuisancesToExclude=options.nuisancesToExclude,
+    stat=options.stat,
+    verbose=options.verbose,
+)
+
+
+def parseFile(fname):
+    with open(fname, "r") as file:
+        return parseCard(file, **parseOptions)
+
+
+def cacheFile(fname):
+    """ the parsed card is stored under the hash of the card and of the parsing options """
+    with open(fname, "rb") as file:
+        content = hashlib.sha1(file.read()).hexdigest()
+    key = ftool.cache.digest(CARD_CACHE_VERSION, options.combineParser, parseOptions, content)
+    return os.path.join(options.cacheDir, key + ".pkl")
+
+
+def parseCards(fnames):
+    """ the parsed cards, from the cache or parsed in a pool of processes """
+    cards = [None] * len(fnames)
+    paths = [None] * len(fnames)
+    if not options.noCache:
+        for i, fname in enumerate(fnames):
+            paths[i] = cacheFile(fname)
+            cards[i] = ftool.cache.load(paths[i])
+    missing = [i for i, DC in enumerate(cards) if DC is None]
+    if len(missing) > 1 and options.jobs > 1:
+        # forked workers see the parser and the options of this process
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(options.jobs, len(missing)), mp_context=multiprocessing.get_context("fork")
+        ) as pool:
+            parsed = list(pool.map(parseFile, [fnames[i] for i in missing]))
+    else:
+        parsed = [parseFile(fnames[i]) for i in missing]
+    for i, DC in zip(missing, parsed):
+        cards[i] = DC
+        if paths[i] is not None:
+            ftool.cache.dump(paths[i], DC)
+    return cards
+
+
+def readCard(fname):
+    """ one parsed card, from the cache if it is there """
+    path = None if options.noCache else cacheFile(fname)
+    DC = ftool.cache.load(path) if path is not None else None
+    if DC is None:
+        DC = parseFile(fname)
+        if path is not None:
+            ftool.cache.dump(path, DC)
+    return DC
+
+
+def newCombination():
+    return Combination(options.channelVetos, options.channelIncludes, options.shape)
+
+
+def combineGroup(group):
+    """ combination of consecutive cards, read in the worker """
+    combination = newCombination()
+    for label, fname in group:
+        combination.add(label, fname, readCard(fname))
+    return combination
+
+
+def mergePair(pair):
+    return pair[0].merge(pair[1]) if len(pair) == 2 else pair[0]
+
+
+def combineTree(inputs):
+    """
+    the cards are combined in groups of options.tree in parallel workers,
+    then the partial combinations are merged two by two until one is left.
+    A worker never holds more than a group of parsed cards
+    """
+    groups = [inputs[i : i + options.tree] for i in range(0, len(inputs), options.tree)]
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max(1, min(options.jobs, len(groups))), mp_context=multiprocessing.get_context("fork")
+    ) as pool:
+        partials = list(pool.map(combineGroup, groups))
+        while len(partials) > 1:
+            pairs = [partials[i : i + 2] for i in range(0, len(partials), 2)]
+            partials = list(pool.map(mergePair, pairs))
+    return partials[0]
 
-obsline = []
-obskeyline = []
-keyline = []
-expline = []
-systlines = {}
-signals = []
-backgrounds = []
-shapeLines = []
-paramSysts = {}
-flatParamNuisances = {}
-discreteNuisances = {}
-groups = {}
-rateParams = {}
-rateParamsOrder = set()
-extArgs = {}
-binParFlags = {}
-nuisanceEdits = []
 
-cmax = 5  # column width
 if not args:
     raise RuntimeError("No input datacards specified.")
+inputs = []
 for ich, fname in enumerate(args):
     label = "ch%d" % (ich + 1)
     if "=" in fname:
         (label, fname) = fname.split("=")
-    fname = options.fprefix + fname
-    dirname = os.path.dirname(fname)
-    file = open(fname, "r")
-    DC = parseCard(file,
-                   bin=options.bin,
-                   noJMax=options.noJMax,
-                   allowNoSignal=options.allowNoSignal,
-                   allowNoBackground=options.allowNoBackground,
-                   evaluateEdits=options.evaluateEdits,
-                   nuisancesToExclude=options.nuisancesToExclude,
-                   stat=options.stat,
-                   verbose=options.verbose)
-    singlebin = len(DC.bins) == 1
-    if label == ".":
-        label = DC.bins[0] if singlebin else ""
-    elif not singlebin:
-        label += "_"
-    for b in DC.bins:
-        bout = label if singlebin else label + b
-        b_in = label if singlebin else b
-        if isVetoed(b_in, options.channelVetos):
-            continue
-        if not isIncluded(b_in, options.channelIncludes):
-            continue
-        obskeyline.append(bout)
-        for (p, e) in DC.exp[b].items():  # so that we get only self.DC.processes contributing to this bin
-            if DC.isSignal[p] == False:
-                continue
-            # print "in DC.exp.items:b,p", b,p
-            expline.append("%s" % FloatToString(e)) if (e == 0 or e > 1e-3) else expline.append(
-                "%s" % FloatToStringScientific(e)
-            )
-            keyline.append((bout, p, DC.isSignal[p]))
-        for (p, e) in DC.exp[b].items():  # so that we get only self.DC.processes contributing to this bin
-            if DC.isSignal[p]:
-                continue
-            # print "in DC.exp.items:b,p", b,p
-            expline.append("%s" % FloatToString(e)) if (e == 0 or e > 1e-3) else expline.append(
-                "%s" % FloatToStringScientific(e)
-            )
-            keyline.append((bout, p, DC.isSignal[p]))
-    # systematics
-    for (lsyst, nofloat, pdf, pdfargs, errline) in DC.systs:
-        systeffect = {}
-        if pdf == "param":
-            if lsyst in paramSysts:
-                if paramSysts[lsyst] != pdfargs:
-                    raise RuntimeError("Parameter uncerainty %s mismatch between cards." % lsyst)
-            else:
-                paramSysts[lsyst] = pdfargs
-            continue
-        for b in DC.bins:
-            bout = label if singlebin else label + b
-            b_in = label if singlebin else b
-            if isVetoed(b_in, options.channelVetos):
-                continue
-            if not isIncluded(b_in, options.channelIncludes):
-                continue
-            if bout not in systeffect:
-                systeffect[bout] = {}
-            for p in DC.exp[b].keys():  # so that we get only self.DC.processes contributing to this bin
-                r = str(errline[b][p])
-                if type(errline[b][p]) == list:
-                    r = "%s/%s" % (FloatToString(errline[b][p][0]), FloatToString(errline[b][p][1]))
-                elif type in ("lnN", "gmM"):
-                    r = "%s" % FloatToString(errline[b][p])
-                if errline[b][p] == 0:
-                    r = "-"
-                if len(r) > cmax:
-                    cmax = len(r)  # get max col length, as it's more tricky to do it later with a map
-                systeffect[bout][p] = r
-        if lsyst in systlines:
-            (otherpdf, otherargs, othereffect, othernofloat) = systlines[lsyst]
-            if otherpdf != pdf:
-                if pdf == "lnN" and otherpdf.startswith("shape"):
-                    if systlines[lsyst][0][-1] != "?":
-                        systlines[lsyst][0] += "?"
-                    for b, v in systeffect.items():
-                        othereffect[b] = v
-                elif pdf.startswith("shape") and otherpdf == "lnN":
-                    if pdf[-1] != "?":
-                        pdf += "?"
-                    systlines[lsyst][0] = pdf
-                    for b, v in systeffect.items():
-                        othereffect[b] = v
-                elif (pdf == otherpdf + "?") or (pdf + "?" == otherpdf):
-                    systlines[lsyst][0] = pdf.replace("?", "") + "?"
-                    for b, v in systeffect.items():
-                        othereffect[b] = v
-                else:
-                    raise RuntimeError(
-                        "File %s defines systematic %s as using pdf %s, while a previous file defines it as using %s"
-                        % (fname, lsyst, pdf, otherpdf)
-                    )
-            else:
-                if pdf == "gmN" and int(pdfargs[0]) != int(otherargs[0]):
-                    raise RuntimeError(
-                        "File %s defines systematic %s as using gamma with %s events in sideband, while a previous file has %s"
-                        % (fname, lsyst, pdfargs[0], otherargs[0])
-                    )
-                for b, v in systeffect.items():
-                    othereffect[b] = v
-        else:
-            pdfargs = [str(x) for x in pdfargs]
-            systlines[lsyst] = [pdf, pdfargs, systeffect, nofloat]
-    # flat params
-    for K in six.iterkeys(DC.flatParamNuisances):
-        flatParamNuisances[K] = True
-    for K in DC.extArgs.keys():
-        extArgs[K] = DC.extArgs[K]
-    for K in six.iterkeys(DC.binParFlags):
-        tbin = label if singlebin else label + K
-        binParFlags[tbin] = DC.binParFlags[K]
-    # rate params
-    for K in six.iterkeys(DC.rateParams):
-        tbin, tproc = K.split("AND")[0], K.split("AND")[1]
-        b_in = tbin
-        tbin = label if singlebin else label + tbin
-        if isVetoed(b_in, options.channelVetos):
-            continue
-        if not isIncluded(b_in, options.channelIncludes):
-            continue
-        nK = tbin + "AND" + tproc
-        rateParams[nK] = DC.rateParams[K]
-        rateParamsOrder.update(DC.rateParamsOrder)
-    # discrete nuisance
-    for K in DC.discretes:
-        if K in discreteNuisances:
-            raise RuntimeError("Cannot currently correlate discrete nuisances across categories. Rename %s in one." % K)
-        else:
-            discreteNuisances[K] = True
-    # put shapes, if available
-    if len(DC.shapeMap):
-        for b in DC.bins:
-            bout = label if singlebin else label + b
-            b_in = label if singlebin else b
-            if isVetoed(b_in, options.channelVetos):
-                continue
-            if not isIncluded(b_in, options.channelIncludes):
-                continue
-            p2sMap = DC.shapeMap[b] if b in DC.shapeMap else {}
-            p2sMapD = DC.shapeMap["*"] if "*" in DC.shapeMap else {}
-            for p, x in p2sMap.items():
-                xrep = [xi.replace("$CHANNEL", b) for xi in x]
-                if xrep[0] != "FAKE" and dirname != "":
-                    xrep[0] = dirname + "/" + xrep[0]
-                shapeLines.append((p, bout, xrep))
-            for p, x in p2sMapD.items():
-                if p in p2sMap:
-                    continue
-                xrep = [xi.replace("$CHANNEL", b) for xi in x]
-                if xrep[0] != "FAKE" and dirname != "":
-                    xrep[0] = dirname + "/" + xrep[0]
-                shapeLines.append((p, bout, xrep))
-    elif options.shape:
-        for b in DC.bins:
-            bout = label if singlebin else label + b
-            shapeLines.append(("*", bout, ["FAKE"]))
-    # combine observations, but remove line if any of the datacards doesn't have it
-    if len(DC.obs) == 0:
-        obsline = None
-    elif obsline != None:
-        for b in DC.bins:
-            bout = label if singlebin else label + b
-            b_in = label if singlebin else b
-            if isVetoed(b_in, options.channelVetos):
-                continue
-            if not isIncluded(b_in, options.channelIncludes):
-                continue
-            obsline += [FloatToString(DC.obs[b])]
-    # get the groups - keep nuisances in a set so that they are never repetitions
-    for groupName, nuisanceNames in six.iteritems(DC.groups):
-        if groupName in groups:
-            groups[groupName].update(set(nuisanceNames))
-        else:
-            groups[groupName] = set(nuisanceNames)
-
-    # Finally report nuisance edits propagated to end of card
-    for editline in DC.nuisanceEditLines:
-        if len(editline) == 2:
-            nuisanceEdits.append("%s %s" % (editline[0], " ".join(editline[1])))
-        else:
-
-            tmp_chan = editline[2]
-            tmp_proc = editline[1]
-            if tmp_chan == "*":  # all channels
-                tmp_chan = "%s(%s)" % (label, "|".join(c for c in DC.bins)) if len(DC.bins) > 1 else label
-            else:
-                tmp_chan = label + tmp_chan
-            if tmp_proc == "*":
-                tmp_proc = "(%s)" % ("|".join(p for p in DC.processes))
-            nuisanceEdits.append("%s %s %s %s" % (editline[0], tmp_proc, tmp_chan, " ".join(editline[3])))
-
-bins = []
-for (b, p, s) in keyline:
-    if b not in bins:
-        bins.append(b)
-    if s:
-        if p not in signals:
-            signals.append(p)
-    else:
-        if p not in backgrounds:
-            backgrounds.append(p)
-
-print("Combination of", "  ".join(args))
-print("imax %d number of bins" % len(bins))
-print("jmax %d number of processes minus 1" % (len(signals) + len(backgrounds) - 1))
-print("kmax %d number of nuisance parameters" % (len(systlines) + len(paramSysts)))
-print("-" * 130)
-
-if shapeLines:
-    chmax = max([max(len(p), len(c)) for p, c, x in shapeLines])
-    cfmt = "%-" + str(chmax) + "s "
-    #shapeLines.sort(key=lambda x: cmp(x[0], y[0]) if x[1] == y[1] else cmp(x[1], y[1]))
-    shapeLines.sort()
-    for (process, channel, stuff) in shapeLines:
-        print("shapes", cfmt % process, cfmt % channel, " ".join(stuff))
-    print("-" * 130)
+    inputs.append((label, options.fprefix + fname))
 
-if obsline:
-    cmax = max([cmax] + [len(l) for l in obskeyline] + [len(x) for x in obsline])
-    cfmt = "%-" + str(cmax) + "s"
-    print("bin         ", "  ".join([cfmt % x for x in obskeyline]))
-    print("observation ", "  ".join([cfmt % x for x in obsline]))
-
-print("-" * 130)
-
-pidline = []
-signals = []
-backgrounds = []
-tmpsignals = []
-for (b, p, s) in keyline:
-    if s:
-        if p not in tmpsignals:
-            tmpsignals.append(p)
-for (b, p, s) in keyline:
-    if s:
-        if p not in signals:
-            signals.append(p)
-        pidline.append(signals.index(p) - len(tmpsignals) + 1)
-    else:
-        if p not in backgrounds:
-            backgrounds.append(p)
-        pidline.append(1 + backgrounds.index(p))
-cmax = max([cmax] + [max(len(p), len(b)) for p, b, s in keyline] + [len(e) for e in expline])
-hmax = max([10] + [len("%-12s[nofloat]  %s %s" % (l, p, a)) for l, (p, a, e, nf) in systlines.items()])
-cfmt = "%-" + str(cmax) + "s"
-hfmt = "%-" + str(hmax) + "s  "
-print(hfmt % "bin", "  ".join([cfmt % p for p, b, s in keyline]))
-print(hfmt % "process", "  ".join([cfmt % b for p, b, s in keyline]))
-print(hfmt % "process", "  ".join([cfmt % x for x in pidline]))
-print(hfmt % "rate", "  ".join([cfmt % x for x in expline]))
-
-print("-" * 130)
-
-sysnamesSorted = list(systlines.keys())
-sysnamesSorted.sort()
-for name in sysnamesSorted:
-    (pdf, pdfargs, effect, nofloat) = systlines[name]
-    if nofloat:
-        name += "[nofloat]"
-    systline = []
-    for b, p, s in keyline:
-        try:
-            systline.append(effect[b][p])
-        except KeyError:
-            systline.append("-")
-    print(hfmt % ("%-21s   %s  %s" % (name, pdf, " ".join(pdfargs))), "  ".join([cfmt % x for x in systline]))
-for (pname, pargs) in paramSysts.items():
-    print("%-12s  param  %s" % (pname, " ".join(pargs)))
-
-for pname in six.iterkeys(flatParamNuisances):
-    print("%-12s  flatParam" % pname)
-for pname in six.iterkeys(rateParams):
-    for pk in range(len(rateParams[pname])):
-        print("%-12s  rateParam %s" % (rateParams[pname][pk][0][0], pname.replace("AND", " ")), end=" ")
-        for p in rateParams[pname][pk][0][1:-1]:
-            print(p, end=" ")
-        print(rateParams[pname][pk][1], end=" ")
-        print("\n", end=" ")
-for dname in six.iterkeys(discreteNuisances):
-    print("%-12s  discrete" % dname)
-for ext in six.iterkeys(extArgs):
-    print("%s" % " ".join(extArgs[ext]))
-for groupName, nuisanceNames in six.iteritems(groups):
-    nuisances = " ".join(nuisanceNames)
-    print("%(groupName)s group = %(nuisances)s" % locals())
-for bpf in six.iterkeys(binParFlags):
-    if len(binParFlags[bpf]) == 1:
-        print("%s autoMCStats %g" % (bpf, binParFlags[bpf][0]))
-    if len(binParFlags[bpf]) == 2:
-        print("%s autoMCStats %g %i" % (bpf, binParFlags[bpf][0], binParFlags[bpf][1]))
-    if len(binParFlags[bpf]) == 3:
-        print("%s autoMCStats %g %i %i" % (bpf, binParFlags[bpf][0], binParFlags[bpf][1], binParFlags[bpf][2]))
-
-nuisanceEdits = set(nuisanceEdits)
-for edit in nuisanceEdits:
-    print("nuisance edit ", edit)
+if options.tree > 0 and len(inputs) > options.tree:
+    combination = combineTree(inputs)
+else:
+    combination = newCombination()
+    for (label, fname), DC in zip(inputs, parseCards([fname for label, fname in inputs])):
+        combination.add(label, fname, DC)
 
+extra = None
 if options.editNuisFile:
-    file = open(options.editNuisFile, "r")
-    str = file.read()
-    print(str)
+    with open(options.editNuisFile, "r") as file:
+        extra = file.read()
+
+sys.stdout.write(combination.format(args, extra))
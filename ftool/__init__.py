@@ -1,14 +1,84 @@
 from __future__ import division
 
 import numpy as np
-import uproot
-import uproot_methods
 import os
-import re
-import physt
-from . import methods
-
-__all__ = ['datacard', 'datagroup', "plot", "methods"]
+import logging
+import resource
+import collections
+import concurrent.futures
+# uproot and methods (built on it) are imported where the ROOT files are
+# read or written, the card parser and the combination can do without
+from . import cache
+from . import bank
+from . import normalisation
+from . import keyindex
+from . import staging
+from . import nuisances
+from . import manifest
+from . import cardparser
+from . import combination
+
+__all__ = ['datacard', 'datagroup', "combine_cards", "plot", "methods"]
+
+logger = logging.getLogger(__name__)
+
+
+# high-water mark of the process before the last reset_peak_rss()
+_peak_rss = 0.
+
+
+def _high_water_mark():
+     # VmHWM can be reset, ru_maxrss is the fallback outside linux
+     try:
+          with open("/proc/self/status") as f:
+               for line in f:
+                    if line.startswith("VmHWM:"):
+                         return int(line.split()[1]) / 1024.
+     except (OSError, ValueError, IndexError):
+          pass
+     return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def peak_rss(since_reset=False):
+     """
+     peak resident memory in MB, of the whole process or only since
+     the last call to reset_peak_rss()
+     """
+     if since_reset:
+          return _high_water_mark()
+     return max(_peak_rss, _high_water_mark())
+
+
+def reset_peak_rss():
+     """ start a new high-water mark, False when the kernel cannot """
+     global _peak_rss
+     _peak_rss = peak_rss()
+     try:
+          with open("/proc/self/clear_refs", "w") as f:
+               f.write("5")
+     except OSError:
+          return False
+     return True
+
+
+def imap(function, items, workers=1):
+     """
+     ordered map, spread over a pool of threads when workers > 1. At most
+     workers items are in flight, so the results waiting to be consumed do
+     not grow with the number of items
+     """
+     if workers is None or workers <= 1:
+          for item in items:
+               yield function(item)
+          return
+     with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+          pending = collections.deque()
+          for item in items:
+               pending.append(pool.submit(function, item))
+               if len(pending) >= workers:
+                    yield pending.popleft().result()
+          while pending:
+               yield pending.popleft().result()
 
 def draw_ratio(nom, uph, dwh, name):
      import matplotlib.pyplot as plt
@@ -44,7 +114,9 @@ class datagroup:
      def __init__(self, files, observable="measMET", name = "DY",
                   channel="", kfactor=1.0, ptype="background",
                   luminosity= 1.0, rebin=1, normalise=True,
-                  xsections=None, mergecat=True, binrange=None):
+                  xsections=None, mergecat=True, binrange=None,
+                  cachedir=None, load=True, workers=1, lazy=False,
+                  repair="zero", lowmem=False, dtype=np.float64):
           self._files  = files
           self.name    = name
           self.ptype   = ptype
@@ -56,187 +128,361 @@ class datagroup:
           self.systvar = set()
           self.rebin   = rebin
           self.binrange= binrange # droping bins the same way as droping elements in numpy arrays a[1:3]
+          self.observable = observable
+          self.kfactor = kfactor
+          self.mergecat= mergecat
+          self.loaded  = False
+          self.workers = workers
+          self.lazy    = lazy
+          self.merged  = None
+          self.repair  = repair # policy for the negative bins, see bank.repair_negative
+          self.repaired= {}
+          # in low memory mode the categories are unrolled into self.merged
+          # as soon as they are accumulated instead of being kept aside
+          self.lowmem  = lowmem
+          self.dtype   = dtype
+          self._layout = None
+
+          # the names used to select the histograms in the files
+          self._categories = [channel] if isinstance(channel, str) else list(channel)
+          if isinstance(channel, str):
+               self.mergecat = False
+          else:
+               self.channel = [keyindex.rename(n) for n in self.channel]
+          self._renamed = dict(zip(
+               self._categories,
+               [self.channel] if isinstance(channel, str) else self.channel
+          ))
+          self.process = "signal" if self.ptype.lower() == "signal" else self.name
+
+          # the normalisation factors and key lists are worth keeping for every file
+          self.norm = normalisation.open_index(
+               os.path.join(cachedir, "normalisation") if cachedir else None
+          )
+          self.keys = keyindex.open_index(
+               os.path.join(cachedir, "keys") if cachedir else None
+          )
 
-          for fn in self._files:
-               _proc = os.path.basename(fn).replace(".root","")
-               _file = uproot.open(fn)
-
-               if not _file:
-                    raise ValueError("%s is not a valid rootfile" % self.name)
-
-               _scale = 1
-               if ptype.lower() != "data":
-                    _scale  = self.xs_scale(ufile=_file, proc=_proc)
-                    _scale *= kfactor
-
-               histograms = None
-               if isinstance(channel, str):
-                    histograms = _file.allitems(
-                         filterclass=lambda cls: issubclass(
-                              cls, uproot_methods.classes.TH1.Methods
-                         ),
-                         filtername =lambda name: (
-                              observable in name.decode("utf-8") and channel in name.decode("utf-8")
-                         )
-                    )
-                    histograms.sort(reverse=True)
-                    mergecat = False
-
-               else:
-                    histograms = _file.allitems(
-                         filterclass=lambda cls: issubclass(
-                              cls, uproot_methods.classes.TH1.Methods
-                         ),
-                         filtername =lambda name: (
-                              observable in name.decode("utf-8") and np.any(
-                                   [cat in name.decode("utf-8") for cat in channel]
-                              )
-                         )
-                    )
-                    histograms.sort(reverse=True)
-                    self.channel = [
-                         "cat0Jet" if "catSignal-0jet" in n else n for n in self.channel
-                    ]
-                    self.channel = [
-                         "cat1Jet" if "catSignal-1jet" in n else n for n in self.channel
+          # signal points change from one card to the other, only the
+          # backgrounds and data are worth keeping on disk
+          self.cache_file = None
+          if cachedir is not None and ptype.lower() != "signal":
+               self.cache_file = os.path.join(cachedir, self.cache_key() + ".pkl")
+               self.loaded = self.load_cache(self.cache_file)
+
+          if load and not self.loaded and self.lazy:
+               # only the key lists and the normalisation are read here,
+               # the templates are loaded by get() when first requested
+               self._selected = {}
+               self._materialized = set()
+               self._read = set()
+               for fn in self._files:
+                    self._selected[fn] = self.keys.select(fn, self.observable, self._categories)
+                    for key in self._selected[fn]:
+                         fields = self.fields(key)
+                         if fields["systematic"] is not None:
+                              self.systvar.add((fields["systematic"], fields["direction"]))
+                    if self.ptype.lower() != "data":
+                         self.norm.sumw(fn)
+          elif load and not self.loaded:
+               # files are read concurrently but always summed in the same order
+               for templates in imap(self.load_file, self._files, self.workers):
+                    self.accumulate(templates)
+               self.finalize()
+
+     @classmethod
+     def multichannel(cls, files, channels, **kwargs):
+          """
+          build one datagroup per entry of channels reading each file
+          only once, the entries hold the per channel arguments
+          (channel, observable, rebin, binrange ...)
+          """
+          groups = {}
+          for label, settings in channels.items():
+               options = dict(kwargs)
+               options.update(settings)
+               # lazy groups read their templates on demand anyway
+               groups[label] = cls(files, load=options.get("lazy", False), **options)
+          if kwargs.get("lazy", False):
+               return groups
+          pending = [g for g in groups.values() if not g.loaded]
+          if not pending:
+               return groups
+          import uproot
+          def load_file(fn):
+               with uproot.open(staging.path(fn)) as _file:
+                    selected = [g.keys.select(fn, g.observable, g._categories, _file) for g in pending]
+                    histograms = {}
+                    for keys in selected:
+                         for key in keys:
+                              if key[0] not in histograms:
+                                   histograms[key[0]] = keyindex.read(_file, key)
+                    return [
+                         g.process_file(fn, _file, [(key, histograms[key[0]]) for key in keys])
+                         for g, keys in zip(pending, selected)
                     ]
+          for partials in imap(load_file, files, kwargs.get("workers", 1)):
+               for g, templates in zip(pending, partials):
+                    g.accumulate(templates)
+          for g in pending:
+               g.finalize()
+          return groups
+
+     def read_histograms(self, fn, ufile):
+          return [
+               (key, keyindex.read(ufile, key))
+               for key in self.keys.select(fn, self.observable, self._categories, ufile)
+          ]
+
+     def load_file(self, fn):
+          """ templates of one file, the file is closed before returning """
+          import uproot
+          with uproot.open(staging.path(fn)) as _file:
+               return self.process_file(fn, _file, self.read_histograms(fn, _file))
+
+     def fields(self, key):
+          """ parsed fields of an index entry, guessed if it is outside the convention """
+          if key[3] is not None:
+               return key[3]
+          name = key[0].decode("utf-8")
+          return keyindex.guess(
+               name, self.observable, next(c for c in self._categories if c in name)
+          )
 
-               for name, roothist in histograms:
-                    name = name.decode("utf-8")
-                    name = name.replace(_proc, self.name)
-                    name = name.replace(";1", "")
-
-                    if ptype.lower() == "signal":
-                         name = name.replace(self.name, "signal")
-                    if "catSignal-0jet" in name:
-                         name = name.replace("catSignal-0jet", "cat0Jet")
-                    if "catSignal-1jet" in name:
-                         name = name.replace("catSignal-1jet", "cat1Jet")
-
-                    roothist = self.check_shape(roothist)
-                    ph_hist = roothist.physt()
-                    newhist = physt.histogram1d.Histogram1D(
-                        ph_hist.binning, 
-                        ph_hist.frequencies, 
-                        errors2=roothist.variances
-                    ) * _scale
-                    # select bin per range   
-                    if isinstance(self.binrange, list):
-                        newhist = physt.histogram1d.Histogram1D(
-                            physt.binnings.NumpyBinning(ph_hist.numpy_bins[self.binrange[0]:self.binrange[1]]), 
-                            ph_hist.frequencies[self.binrange[0]:self.binrange[1]], 
-                            errors2=roothist.variances[self.binrange[0]:self.binrange[1]]
-                        ) * _scale
-                        
-                    # merge bins
-                    if self.rebin >= 1:
-                        rebinned_hist = newhist.merge_bins(rebin)
-                        newhist = physt.histogram1d.Histogram1D(
-                            physt.binnings.NumpyBinning(rebinned_hist.numpy_bins),
-                            rebinned_hist.frequencies,
-                            errors2=rebinned_hist.errors2
-                        )
-                        
-                    newhist.name = name
-                    if name in self.nominal.keys():
-                         self.nominal[name] += newhist
-                    else:
-                         self.nominal[name] = newhist
-
-                    try:
-                         self.systvar.add(re.search("sys_[\w.]+", name).group())
-                    except:
-                         pass
-
-          if mergecat:
-            # merging the nominal
-            self.merged = {}
-            for syst in self.systvar:
-                m_hist = self.merge_cat(self.nominal, lambda elem: syst in elem[0])
-                self.merged[m_hist[0]] = m_hist
-            m_hist = self.merge_cat(self.nominal, lambda elem: "sys" not in elem[0])
-            self.merged[m_hist[0]] = m_hist
+     def process_file(self, fn, ufile, histograms):
+          """ scaled and rebinned (TemplateKey, edges, sumw, sumw2, repaired bins) of one file """
+          _proc = os.path.basename(fn).replace(".root","")
+          if not ufile:
+               raise ValueError("%s is not a valid rootfile" % self.name)
+
+          _scale = 1
+          if self.ptype.lower() != "data":
+               _scale  = self.xs_scale(fn, proc=_proc, ufile=ufile)
+               _scale *= self.kfactor
+
+          # histograms sharing a binning are handled as one (template, bin) array
+          groups = {}
+          for key, roothist in histograms:
+               groups.setdefault(roothist.edges.tobytes(), []).append((key, roothist))
+
+          templates = []
+          for group in groups.values():
+               names = []
+               for key, roothist in group:
+                    fields = self.fields(key)
+                    names.append(keyindex.TemplateKey(
+                         self.process, fields["observable"], self._renamed[fields["channel"]],
+                         fields["systematic"], fields["direction"]
+                    ))
+               # copied so that nothing points to the file once it is closed
+               edges = np.array(group[0][1].edges, dtype=np.float64)
+               sumw  = np.array([h.values    for _, h in group], dtype=np.float64)
+               sumw2 = np.array([h.variances for _, h in group], dtype=np.float64)
+               sumw, repaired = bank.repair_negative(sumw, self.repair)
+               # select bin per range
+               if isinstance(self.binrange, list):
+                    ibins = np.arange(sumw.shape[1])[self.binrange[0]:self.binrange[1]]
+                    edges = edges[ibins[0]:ibins[-1] + 2]
+                    sumw  = sumw [:, ibins[0]:ibins[-1] + 1]
+                    sumw2 = sumw2[:, ibins[0]:ibins[-1] + 1]
+               sumw  = sumw  * _scale
+               sumw2 = sumw2 * _scale**2
+
+               # merge bins
+               if self.rebin > 1:
+                    edges, sumw, sumw2 = bank.merge_bins(edges, sumw, sumw2, self.rebin)
+
+               templates += [
+                    (name, edges, sumw[i], sumw2[i], repaired[i])
+                    for i, name in enumerate(names)
+               ]
+          return templates
+
+     def accumulate(self, templates):
+          for name, edges, sumw, sumw2, repaired in templates:
+               if repaired:
+                    self.repaired[name] = self.repaired.get(name, 0) + int(repaired)
+               if name.systematic is not None:
+                    self.systvar.add((name.systematic, name.direction))
+               if self._layout is not None:
+                    self.add_unrolled(name, sumw, sumw2)
+                    continue
+               if name.channel not in self.nominal:
+                    self.nominal[name.channel] = bank.HistogramBank(edges, dtype=self.dtype)
+               self.nominal[name.channel].add(name, sumw, sumw2)
+          # the layout is known once every category has been seen
+          if self.lowmem and self.mergecat and self._layout is None and all(
+                    c in self.nominal for c in self.channel):
+               self.unroll()
+
+     def unroll(self):
+          """ move the per category templates into self.merged and free them """
+          channels = [c for c in self.channel if c in self.nominal]
+          if not channels:
+               return
+          edges, starts = bank.unroll_edges([self.nominal[c].edges for c in channels])
+          self._layout = {
+               c: (first, first + self.nominal[c].numbins) for c, first in zip(channels, starts)
+          }
+          if self.merged is None:
+               self.merged = bank.HistogramBank(edges, dtype=self.dtype)
+          nominal, self.nominal = self.nominal, {}
+          for c in channels:
+               for name, template in nominal[c].items():
+                    self.add_unrolled(name, template.frequencies, template.errors2)
+
+     def add_unrolled(self, name, sumw, sumw2):
+          if name.channel not in self._layout:
+               raise ValueError("{}: {} is not part of the merged layout".format(self.name, name.channel))
+          first, last = self._layout[name.channel]
+          irow = self.merged.row_index(name._replace(channel=None))
+          self.merged.sumw [irow, first:last] += sumw
+          self.merged.sumw2[irow, first:last] += sumw2
+
+     def nbytes(self):
+          """ memory held by the templates """
+          banks = list(self.nominal.values())
+          if self.merged is not None and all(self.merged is not b for b in banks):
+               banks.append(self.merged)
+          return sum(b.sumw.nbytes + b.sumw2.nbytes for b in banks)
+
+     def merge(self, variations):
+          """
+          fill self.merged with the given (systematic, direction)
+          variations, (None, None) being the nominal
+          """
+          if self.mergecat and self.lowmem:
+               # already unrolled while accumulating
+               if self._layout is None:
+                    self.unroll()
+          elif self.mergecat:
+               self.merge_cat(variations)
           else:
-            self.merged = {i: (i, c) for i,c  in self.nominal.items()}
-     
-     def check_shape(self, histogram):
-          for ibin in range(histogram.numbins+1):
-               if histogram[ibin] < 0:
-                    histogram[ibin] = 0
-          return histogram
-
-     def merge_cat(self, hitograms, callback):
-          filtredhist = dict()
-          for (key, value) in hitograms.items():
-               if callback((key, value)):
-                    filtredhist[key] = value
-          merged_hist = []
-          merged_bins = []
-          merged_cent = []
-          first=True
-          #return filtredhist
-          iteration = sorted(
-               filtredhist.items(),
-               key=lambda pair: self.channel.index(pair[0].split("_")[2])
+               self.merged = self.nominal.get(self.channel)
+
+     def materialize(self, systvar):
+          """ read, scale and merge the templates of one variation on first use """
+          def wanted(fn, key):
+               if (fn, key[0]) in self._read:
+                    return False
+               if systvar == "nom":
+                    return self.fields(key)["systematic"] is None
+               return self.fields(key)["systematic"] == systvar
+
+          import uproot
+          def load_file(fn):
+               keys = [key for key in self._selected[fn] if wanted(fn, key)]
+               self._read.update((fn, key[0]) for key in keys)
+               if not keys:
+                    return []
+               with uproot.open(staging.path(fn)) as _file:
+                    return self.process_file(
+                         fn, _file, [(key, keyindex.read(_file, key)) for key in keys]
+                    )
+
+          variations = set()
+          for templates in imap(load_file, self._files, self.workers):
+               self.accumulate(templates)
+               variations.update((t[0].systematic, t[0].direction) for t in templates)
+          self.merge(sorted(variations, key=str))
+          self._materialized.add(systvar)
+
+     def finalize(self):
+          self.merge(list(self.systvar) + [(None, None)])
+          self.loaded = True
+
+          if self.cache_file is not None:
+               self.dump_cache(self.cache_file)
+
+     def cache_key(self):
+          procs = [os.path.basename(fn).replace(".root","") for fn in self._files]
+          xsecs = None
+          if self.xsec is not None and self.ptype.lower() != "data":
+               xsecs = [self.xsec.get(proc) for proc in procs]
+          return cache.digest(
+               cache.CACHE_VERSION, self.name, self.ptype, self.observable,
+               self.channel, self.kfactor, self.lumi, self.rebin, self.binrange,
+               self.mergecat, self.repair, self.lowmem, np.dtype(self.dtype).name, xsecs,
+               [cache.fingerprint(fn) for fn in self._files]
           )
-          print("how many histos : ", iteration)
-          for name, h in iteration:
-               
-               if first:
-                    merged_bins = h.numpy_bins
-                    merged_cent = h.bin_centers
-                    merged_hist = h.frequencies
-                    merged_var  = h.errors2
-                    first = False
-               else:
-                    new_bins = h.numpy_bins
-                    new_bin_cent = h.bin_centers
-                    
-                    if merged_bins[-1] == new_bins[-1]:
-                        new_bins = new_bins + merged_bins[-1] + 10
-                    else:
-                        new_bins = new_bins + merged_bins[-1]
-
-                    merged_bins = np.concatenate([merged_bins, new_bins])
-                    merged_cent = np.array([0.5*(merged_bins[i+1] + merged_bins[i]) for i in range(merged_bins.shape[0]-1)])
-                    new_frequencies = h.frequencies
-                    new_frequencies = [0.0, *new_frequencies]
-                    merged_hist = np.concatenate([merged_hist, new_frequencies])
-                    new_error = h.errors2
-                    new_error = [0.0, *new_error]
-                    merged_var = np.concatenate([merged_var, new_error])
-
-          cat = re.search('cat(.*)', name).group().split("_")[0]
-          print("binning : ", merged_bins)
-          print("centers : ", merged_cent)
-          print("histogr : ", merged_hist)
-          print("var     : ", merged_var)
-          physt.binnings.NumpyBinning(merged_cent)
-          physt.binnings.NumpyBinning(merged_bins)
-          if len(merged_hist):
-               new_hist = physt.histogram1d.Histogram1D(
-                   bin_centers = physt.binnings.NumpyBinning(merged_cent),
-                   #bin_centers= merged_cent,
-                   frequencies= merged_hist, 
-                   binning = physt.binnings.NumpyBinning(merged_bins),
-                   errors2 = merged_var
-               )
 
-               return name.replace("_" + cat, ""), new_hist
-          else:
+     def load_cache(self, cache_file):
+          payload = cache.load(cache_file)
+          if payload is None:
+               return False
+          self.channel = payload["channel"]
+          self.systvar = payload["systvar"]
+          self.nominal = payload["nominal"]
+          self.merged  = payload["merged"]
+          self.repaired= payload["repaired"]
+          return True
+
+     def dump_cache(self, cache_file):
+          for b in self.nominal.values():
+               b.compact()
+          cache.dump(cache_file, {
+               "channel": self.channel,
+               "systvar": self.systvar,
+               "nominal": self.nominal,
+               "merged" : self.merged,
+               "repaired": self.repaired,
+          })
+     
+     def repair_report(self):
+          """ number of negative bins repaired in each template, summed over the files """
+          return {str(name): n for name, n in sorted(self.repaired.items(), key=str)}
+
+     def merge_cat(self, variations):
+          """
+          unroll the categories of every variation into a single template,
+          the layout is computed once and all variations are copied in
+          one go per category
+          """
+          channels = [c for c in self.channel if c in self.nominal]
+          if not channels:
                return
+          edges, starts = bank.unroll_edges([self.nominal[c].edges for c in channels])
+          if self.merged is None:
+               self.merged = bank.HistogramBank(edges, capacity=len(variations), dtype=self.dtype)
+          names = [
+               keyindex.TemplateKey(self.process, self.observable, None, *syst)
+               for syst in variations
+          ]
+          rows = [self.merged.row_index(name) for name in names]
+          logger.debug("%s: unrolling %s into %d bins", self.name, channels, edges.shape[0] - 1)
+          for channel, first in zip(channels, starts):
+               nominal = self.nominal[channel]
+               found = [
+                    (row, nominal.index[name._replace(channel=channel)])
+                    for row, name in zip(rows, names)
+                    if name._replace(channel=channel) in nominal
+               ]
+               if len(found) < len(rows):
+                    logger.debug("%s: %d variations missing in %s", self.name, len(rows) - len(found), channel)
+               if not found:
+                    continue
+               outrows, inrows = [list(r) for r in zip(*found)]
+               last = first + nominal.numbins
+               self.merged.sumw [outrows, first:last] = nominal.sumw [inrows]
+               self.merged.sumw2[outrows, first:last] = nominal.sumw2[inrows]
 
      def get(self, systvar, merged=True):
-          shapeUp, shapeDown= None, None
-          for n, hist in self.merged.items():
-               if "sys" not in n and systvar=="nom":
-                    return hist[1]
-               elif systvar in n:
-                    if "Up" in n:
-                         shapeUp = hist[1]
-                    if "Down" in n:
-                         shapeDown= hist[1]
-          return (shapeUp, shapeDown)
+          if self.lazy and not self.loaded and systvar not in self._materialized:
+               self.materialize(systvar)
+          if self.merged is None:
+               return (None, None)
+          key = keyindex.TemplateKey(
+               self.process, self.observable,
+               None if self.mergecat else self.channel, None, None
+          )
+          if systvar == "nom":
+               return self.merged.get(key) if key in self.merged else (None, None)
+          return tuple(
+               self.merged.get(k) if k in self.merged else None for k in (
+                    key._replace(systematic=systvar, direction="Up"),
+                    key._replace(systematic=systvar, direction="Down")
+               )
+          )
 
      def save(self, filename=None, working_dir="fitroom", force=True):
           if not filename:
@@ -246,28 +492,47 @@ class datagroup:
                     self.name = self.name.replace(self.name, "signal")
           self.outfile = working_dir + "/" + filename
           if os.path.isdir(self.outfile) or force:
+               import uproot
+               from . import methods
                fout = uproot.recreate(self.outfile, compression=uproot.ZLIB(4))
                for name, hist in self.merged.items():
-                    name = name.replace("_sys", "")
+                    name = str(name).replace("_sys", "")
                     if "data" in name:
                          name = name.replace("data", "data_obs")
-                    fout[name] = uproot_methods.classes.TH1.from_numpy(hist)
+                    fout[name] = methods.from_template(hist)
                fout.close()
 
-     def xs_scale(self, ufile, proc):
+     def xs_scale(self, fn, proc, ufile=None):
           xsec  = self.xsec[proc]["xsec"]
           xsec *= self.xsec[proc]["kr"]
           xsec *= self.xsec[proc]["br"]
           xsec *= 1000.0
           #print (proc, xsec)
           assert xsec > 0, "{} has a null cross section!".format(proc)
-          scale = xsec * self.lumi/ufile["Runs"].array("genEventSumw").sum()
+          scale = xsec * self.lumi/self.norm.sumw(fn, ufile)
           return scale
 
 
 
+def compression(spec):
+     """
+     uproot compression from "<algorithm>[:<level>]", the algorithm is one
+     of zlib, lzma, lz4 or none
+     """
+     import uproot
+     algorithm, _, level = spec.lower().partition(":")
+     if algorithm == "none":
+          return None
+     algorithms = {"zlib": uproot.ZLIB, "lzma": uproot.LZMA, "lz4": uproot.LZ4}
+     if algorithm not in algorithms:
+          raise ValueError("unknown compression: {} (choose from {})".format(
+               spec, ", ".join(list(algorithms) + ["none"])
+          ))
+     return algorithms[algorithm](int(level) if level else 1)
+
+
 class datacard:
-     def __init__(self, name, channel="ch1"):
+     def __init__(self, name, channel="ch1", compression="zlib:1", pruning=None):
           self.dc_file = []
           self.name = []
           self.nsignal = 1
@@ -280,108 +545,185 @@ class datacard:
           self.shapes = []
           self.observation = []
           self.rates = []
-          self.nuisances = {}
-          self.extras = set()
-          self.dc_name = "cards-{}/shapes-{}.dat".format(name, channel)
+          self.nuisances = nuisances.NuisanceMatrix()
+          # insertion ordered, the card does not depend on the hash seed
+          self.extras = collections.OrderedDict()
+          # what the text lines hold, for the combination in memory
+          self.observed = None
+          self.shape_map = {}
+          self.rate_params = []
+          self.auto_stat = None
+          self.dc_name = self.card_file(name, channel)
           if not os.path.isdir(os.path.dirname(self.dc_name)):
                os.mkdir(os.path.dirname(self.dc_name))
 
-          self.shape_file = uproot.recreate(
-               "cards-{}/shapes-{}.root".format(name, channel)
-          )
+          # the templates are kept in memory and written at dump()
+          self.shape_name = "cards-{}/shapes-{}.root".format(name, channel)
+          self.compression = compression
+          self.templates = collections.OrderedDict()
+          # the binning of the channel, shared by all its templates
+          self.edges = None
+
+          # shape nuisances dropped or turned into lnN, see nuisances.Pruning
+          self.pruning = pruning
+          self.pruned = []
+
+     @staticmethod
+     def card_file(name, channel):
+          return "cards-{}/shapes-{}.dat".format(name, channel)
 
      def shapes_headers(self):
           filename = self.dc_name.replace("dat", "root")
           lines = "shapes * * {file:<20} $PROCESS $PROCESS_$SYSTEMATIC"
           lines = lines.format(file = os.path.basename(filename))
           self.dc_file.append(lines)
+          self.shape_map["*"] = {
+               "*": [os.path.basename(filename), "$PROCESS", "$PROCESS_$SYSTEMATIC"]
+          }
 
      def add_observation(self, shape):
           value = shape.total
+          self.observed = value
           self.dc_file.append("bin          {0:>10}".format(self.channel))
           self.dc_file.append("observation  {0:>10}".format(value))
-          self.shape_file["data_obs"] = methods.from_physt(shape)
+          self.add_template("data_obs", shape.frequencies, shape.errors2, shape.numpy_bins)
+
+     def add_template(self, name, sumw, sumw2, edges=None):
+          if edges is None:
+               edges = self.nominal_hist.numpy_bins
+          edges = np.asarray(edges, dtype=np.float64)
+          if self.edges is not None and np.array_equal(edges, self.edges):
+               edges = self.edges
+          elif self.edges is None:
+               self.edges = edges
+          # no copy, the templates are views of the bank until dump()
+          self.templates[name] = (edges, np.asarray(sumw), np.asarray(sumw2))
 
      def add_nuisance(self, process, name, value):
-          if name not in self.nuisances:
-               self.nuisances[name] = {}
-          self.nuisances[name][process] = value
+          """ value is a (down, up) pair for an asymmetric lnN """
+          self.nuisances.set(name, process, value)
 
      def add_nominal(self, process, shape):
           value = shape.total
           self.rates.append((process, value))
-          self.shape_file[process] = methods.from_physt(shape)
+          self.add_template(process, shape.frequencies, shape.errors2, shape.numpy_bins)
           self.nominal_hist = shape
 
+     def add_templates(self, templates, edges=None):
+          """ add several name -> (sumw, sumw2) templates in one go """
+          if edges is None:
+               edges = self.nominal_hist.numpy_bins
+          for name, (sumw, sumw2) in templates.items():
+               self.add_template(name, sumw, sumw2, edges)
+
      def add_qcd_scales(self, process, cardname, qcd_scales):
-          nuisance = "{:<20} shape".format(cardname)
           if isinstance(qcd_scales, list):
-               shapes = []
-               for sh in qcd_scales:
-                    uncert_up = np.abs(self.nominal_hist - sh[0])
-                    uncert_dw = np.abs(self.nominal_hist - sh[1])
-                    
-                    var_up = np.divide(
-                        uncert_up, self.nominal_hist.frequencies, 
-                        out=np.zeros_like(uncert_up), 
-                        where=self.nominal_hist.frequencies!=0
-                    )
-                    var_dw = np.divide(
-                        uncert_dw, self.nominal_hist.frequencies, 
-                        out=np.zeros_like(uncert_up), 
-                        where=self.nominal_hist.frequencies!=0
-                    )
-                    uncert_up[var_up >= 0.95] = 0 
-                    uncert_dw[var_dw >= 0.95] = 0 
-                    
-                    uncert = np.maximum(uncert_up,uncert_dw)
-                    
-                    uncert_r =  np.divide(
-                        uncert, self.nominal_hist.frequencies, 
-                        out=np.zeros_like(uncert)*-1, 
-                        where=self.nominal_hist.frequencies!=0
-                    )
-#                     print(" ---  name : ", self.nominal_hist.name, " : ", process, " : ", cardname)
-#                     print("       up  : ", var_up)
-#                     print("       down: ", var_dw)
-#                     print("corr uncert: ", uncert_r)
-                    shapes.append(uncert)
-               shapes = np.array(shapes)
-               uncert = shapes.max(axis=0)
-               h_uncert = physt.histogram1d.Histogram1D(
-                    self.nominal_hist.binning, uncert,
-                    errors2=np.zeros_like(uncert)
+               nominal = self.nominal_hist.frequencies
+               # (scale set, up/down, bin)
+               uncert = np.abs(nominal - np.array([
+                    [sh[0].frequencies, sh[1].frequencies] for sh in qcd_scales
+               ]))
+               var = np.divide(
+                   uncert, nominal,
+                   out=np.zeros_like(uncert),
+                   where=nominal!=0
+               )
+               uncert[var >= 0.95] = 0
+               uncert = uncert.max(axis=(0, 1))
+               errors2 = self.nominal_hist.errors2
+               self.add_variations(
+                    process, [cardname],
+                    np.array([[nominal - uncert, nominal + uncert]]),
+                    np.array([[errors2, errors2]])
                )
-               shape = (self.nominal_hist - h_uncert, self.nominal_hist + h_uncert)
-               self.add_nuisance(process, nuisance, 1.0)
-               self.shape_file[process + "_" + cardname + "Up"  ] = methods.from_physt(shape[0])
-               self.shape_file[process + "_" + cardname + "Down"] = methods.from_physt(shape[1])
           else:
                raise ValueError("add_qcd_scales: the qcd_scales should be a list!")
 
      def add_shape_nuisance(self, process, cardname, shape, symmetrise=False):
-          nuisance = "{:<20} shape".format(cardname)
-          if shape[0] is not None and (
-                    (shape[0].frequencies[shape[0].frequencies>0].shape[0]) and
-                    (shape[1].frequencies[shape[1].frequencies>0].shape[0])
-          ):
-               if shape[0] == shape[1]:
-                    shape = (2 * self.nominal_hist - shape[0], shape[1])
-               if symmetrise: 
-                    uncert = np.maximum(np.abs(self.nominal_hist - shape[0]), 
-                                        np.abs(self.nominal_hist - shape[1]))
-                    h_uncert = physt.histogram1d.Histogram1D(
-                         shape[0].binning, uncert, errors2=np.zeros_like(uncert)
-                    )
-                    shape = (self.nominal_hist - h_uncert, self.nominal_hist + h_uncert)
-               self.add_nuisance(process, nuisance, 1.0)
-               self.shape_file[process + "_" + cardname + "Up"  ] = methods.from_physt(shape[0])
-               self.shape_file[process + "_" + cardname + "Down"] = methods.from_physt(shape[1])
-               if False:
-                    draw_ratio(
-                         self.nominal_hist,
-                         shape[0], shape[1], process + cardname
-                    )
+          self.add_shape_nuisances(process, [(cardname, shape, symmetrise)])
+
+     def add_shape_nuisances(self, process, variations):
+          """
+          add all the shape nuisances of a process at once, variations
+          is a list of (cardname, (up, down), symmetrise)
+          """
+          variations = [v for v in variations if v[1][0] is not None]
+          if not variations:
+               return
+          nominal = self.nominal_hist
+          # (nuisance, up/down, bin)
+          sumw  = np.array([[sh.frequencies for sh in v[1]] for v in variations])
+          sumw2 = np.array([[sh.errors2     for sh in v[1]] for v in variations])
+          symmetrise = np.array([bool(v[2]) for v in variations])
+
+          # both sides need at least one filled bin
+          valid = (sumw > 0).any(axis=2).all(axis=1)
+
+          # one sided variation, mirror it around the nominal
+          onesided = (
+               np.isclose(sumw [:, 0], sumw [:, 1]).all(axis=1) &
+               np.isclose(sumw2[:, 0], sumw2[:, 1]).all(axis=1)
+          )
+          sumw [onesided, 0] = 2 * nominal.frequencies - sumw [onesided, 0]
+          sumw2[onesided, 0] = 4 * nominal.errors2     + sumw2[onesided, 0]
+
+          uncert = np.abs(nominal.frequencies - sumw[symmetrise]).max(axis=1)
+          sumw [symmetrise, 0] = nominal.frequencies - uncert
+          sumw [symmetrise, 1] = nominal.frequencies + uncert
+          sumw2[symmetrise] = nominal.errors2
+
+          self.add_variations(
+               process, [variations[i][0] for i in np.flatnonzero(valid)],
+               sumw[valid], sumw2[valid]
+          )
+
+     def add_variations(self, process, cardnames, sumw, sumw2):
+          """
+          add the (nuisance, up/down, bin) templates of a process, going
+          through the pruning policy when there is one
+          """
+          drop = flat = np.zeros(len(cardnames), dtype=bool)
+          if self.pruning is not None and len(cardnames):
+               drop, flat, kappas, deviation = self.pruning.decide(
+                    cardnames, self.nominal_hist.frequencies, sumw
+               )
+          templates = {}
+          for i, cardname in enumerate(cardnames):
+               if drop[i]:
+                    self.pruned.append((process, cardname, "dropped", deviation[i]))
+               elif flat[i]:
+                    self.pruned.append((process, cardname, "lnN", deviation[i]))
+                    self.add_shape_lnN(process, cardname, tuple(kappas[i]))
+               else:
+                    self.add_shape(process, cardname)
+                    templates[process + "_" + cardname + "Up"  ] = (sumw[i, 0], sumw2[i, 0])
+                    templates[process + "_" + cardname + "Down"] = (sumw[i, 1], sumw2[i, 1])
+          if templates:
+               self.add_templates(templates)
+
+     def add_shape(self, process, cardname):
+          shape  = "{:<20} shape".format(cardname)
+          mixed  = "{:<20} shape?".format(cardname)
+          lognormal = "{:<21}  lnN".format(cardname)
+          if lognormal in self.nuisances:
+               self.nuisances.rename(lognormal, mixed)
+          self.add_nuisance(process, mixed if mixed in self.nuisances else shape, 1.0)
+
+     def add_shape_lnN(self, process, cardname, kappas):
+          """ a pruned shape nuisance as a lnN, shape? once another process has its shape """
+          shape  = "{:<20} shape".format(cardname)
+          mixed  = "{:<20} shape?".format(cardname)
+          lognormal = "{:<21}  lnN".format(cardname)
+          if shape in self.nuisances:
+               self.nuisances.rename(shape, mixed)
+          self.add_nuisance(process, mixed if mixed in self.nuisances else lognormal, kappas)
+
+     def pruning_report(self):
+          """ one line per pruned shape nuisance """
+          return [
+               "{:<10} {:<25} {:<8} max deviation {:.2e}".format(process, cardname, action, deviation)
+               for process, cardname, action, deviation in self.pruned
+          ]
 
      def add_rate_param(self, name, channel, process, vmin=0.1, vmax=10):
           # name rateParam bin process initial_value [min,max]
@@ -393,12 +735,13 @@ class datacard:
                vmin = vmin,
                vmax = vmax
           )
-          self.extras.add(template)
+          if template not in self.extras:
+               self.rate_params.append(template.split())
+          self.extras[template] = None
 
      def add_auto_stat(self):
-          self.extras.add(
-               "{} autoMCStats 0 0 1".format(self.channel)
-          )
+          self.extras["{} autoMCStats 0 0 1".format(self.channel)] = None
+          self.auto_stat = [0., False, 1]
 
      def dump(self):
           # adding shapes
@@ -424,15 +767,66 @@ class datacard:
           self.dc_file.append(indx_line)
           self.dc_file.append(rate_line)
           self.dc_file.append("-"*30)
-          for nuisance in sorted(self.nuisances.keys()):
-               scale = self.nuisances[nuisance]
-               line_ = "{0:<8}".format(nuisance)
-               for process, _ in self.rates:
-                    if process in scale:
-                         line_ += "{0:>15}".format("%.3f" % scale[process])
-                    else:
-                         line_ += "{0:>15}".format("-")
-               self.dc_file.append(line_)
-          self.dc_file += self.extras
-          with open(self.dc_name, "w") as fout:
+          self.dc_file += self.nuisances.format([process for process, _ in self.rates])
+          self.dc_file += list(self.extras)
+          self.dump_shapes()
+          with open(self.dc_name + ".tmp", "w") as fout:
                fout.write("\n".join(self.dc_file))
+          os.replace(self.dc_name + ".tmp", self.dc_name)
+
+     def dump_shapes(self):
+          """
+          write all the templates in one pass to a temporary file, renamed
+          once complete so that a failure never leaves a partial shape file
+          """
+          import uproot
+          from . import methods
+          # the compression is either uproot's or a spec for compression()
+          level = self.compression
+          if isinstance(level, str):
+               level = compression(level)
+          tmpname = self.shape_name + ".tmp"
+          try:
+               with uproot.recreate(tmpname, compression=level) as fout:
+                    fout.update(
+                         (name, methods.from_arrays(edges, sumw, sumw2, name))
+                         for name, (edges, sumw, sumw2) in self.templates.items()
+                    )
+          except Exception:
+               if os.path.exists(tmpname):
+                    os.remove(tmpname)
+               raise
+          os.replace(tmpname, self.shape_name)
+
+
+def combine_cards(cards, filename, labels=None, vetos=(), includes=(), force_shape=False):
+     """
+     write the combination of the cards to filename in one go, like
+     combineCards.py does. The ftool.datacard are merged from memory, the
+     card files given by name are read with the ftool parser. Each card is
+     labelled after labels, its own channel by default, and its shapes are
+     looked up relative to filename
+     """
+     if labels is None:
+          labels = ["."] * len(cards)
+     if len(labels) != len(cards):
+          raise ValueError("combine_cards: {} labels for {} cards".format(len(labels), len(cards)))
+     outdir = os.path.dirname(filename) or "."
+     merged = combination.Combination(vetos, includes, force_shape)
+     inputs = []
+     for label, card in zip(labels, cards):
+          if isinstance(card, datacard):
+               fname = card.dc_name
+               parsed = cardparser.from_datacard(card)
+          else:
+               fname = card
+               with open(fname) as fin:
+                    parsed = cardparser.parse(fin, allowNoSignal=True, allowNoBackground=True)
+          fname = os.path.relpath(fname, outdir)
+          merged.add(label, fname, parsed)
+          inputs.append("{}={}".format(label, fname))
+
+     with open(filename + ".tmp", "w") as fout:
+          fout.write(merged.format(inputs))
+     os.replace(filename + ".tmp", filename)
+     return merged
@@ -0,0 +1,165 @@
+import numpy as np
+
+
+def merge_bins(edges, sumw, sumw2, amount):
+    """
+    join every amount adjacent bins (along the last axis), the last
+    bin collects what is left. Groups are summed bin after bin so the
+    result does not depend on the vectorisation
+    """
+    first = np.arange(0, sumw.shape[-1], amount)
+    new_sumw  = np.zeros(sumw .shape[:-1] + first.shape, dtype=sumw .dtype)
+    new_sumw2 = np.zeros(sumw2.shape[:-1] + first.shape, dtype=sumw2.dtype)
+    for shift in range(amount):
+        ibins = first + shift
+        valid = ibins < sumw.shape[-1]
+        new_sumw [..., valid] += sumw [..., ibins[valid]]
+        new_sumw2[..., valid] += sumw2[..., ibins[valid]]
+    return np.append(edges[first], edges[-1]), new_sumw, new_sumw2
+
+
+REPAIR_POLICIES = ("zero", "epsilon", "renormalise")
+
+
+def repair_negative(sumw, policy="zero", epsilon=1e-6):
+    """
+    fix the negative bins of a (template, bin) array: set them to zero,
+    to epsilon so that no repaired bin is left empty, or to zero scaling
+    the template back to its original integral. Returns the repaired
+    array and the number of bins fixed in each template
+    """
+    if policy not in REPAIR_POLICIES:
+        raise ValueError("unknown repair policy: {}".format(policy))
+    negative = sumw < 0
+    repaired = negative.sum(axis=-1)
+    if not repaired.any():
+        return sumw, repaired
+    fixed = np.where(negative, epsilon if policy == "epsilon" else 0.0, sumw)
+    if policy == "renormalise":
+        before = sumw .sum(axis=-1, keepdims=True)
+        after  = fixed.sum(axis=-1, keepdims=True)
+        fixed *= np.divide(
+            before, after, out=np.ones_like(after), where=(before > 0) & (after > 0)
+        )
+    return fixed, repaired
+
+
+def unroll_edges(binnings):
+    """
+    put several binnings one after the other: each one is shifted by the
+    last edge so far (10 more when both last edges coincide) and an empty
+    bin separates them. Returns the edges and the first bin of each binning
+    """
+    pieces = [binnings[0]]
+    starts = [0]
+    nbins  = binnings[0].shape[0] - 1
+    for edges in binnings[1:]:
+        if pieces[-1][-1] == edges[-1]:
+            edges = edges + pieces[-1][-1] + 10
+        else:
+            edges = edges + pieces[-1][-1]
+        starts.append(nbins + 1)
+        nbins += edges.shape[0]
+        pieces.append(edges)
+    return np.concatenate(pieces), starts
+
+
+class Template(object):
+    """
+    one row of a HistogramBank, frequencies and errors2 are views on
+    the bank arrays so nothing is copied when a template is handed out
+    """
+    __slots__ = ("bank", "row", "name")
+
+    def __init__(self, bank, row, name=None):
+        self.bank = bank
+        self.row  = row
+        self.name = name
+
+    @property
+    def frequencies(self):
+        return self.bank.sumw[self.row]
+
+    @property
+    def errors2(self):
+        return self.bank.sumw2[self.row]
+
+    @property
+    def numpy_bins(self):
+        return self.bank.edges
+
+    @property
+    def bin_centers(self):
+        return (self.bank.edges[:-1] + self.bank.edges[1:]) / 2
+
+    @property
+    def total(self):
+        return self.frequencies.sum()
+
+
+class HistogramBank(object):
+    """
+    templates sharing the same binning: the edges are stored once and
+    the sum of weights and of squared weights are kept in contiguous
+    (template, bin) arrays, rows are looked up by name
+    """
+    def __init__(self, edges, capacity=8, dtype=np.float64):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.names = []
+        self.index = {}
+        self.sumw  = np.zeros((capacity, self.numbins), dtype=dtype)
+        self.sumw2 = np.zeros((capacity, self.numbins), dtype=dtype)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    @property
+    def numbins(self):
+        return self.edges.shape[0] - 1
+
+    def _grow(self, capacity):
+        sumw  = np.zeros((capacity, self.numbins), dtype=self.sumw.dtype)
+        sumw2 = np.zeros((capacity, self.numbins), dtype=self.sumw2.dtype)
+        sumw [:len(self)] = self.sumw [:len(self)]
+        sumw2[:len(self)] = self.sumw2[:len(self)]
+        self.sumw, self.sumw2 = sumw, sumw2
+
+    def row_index(self, name):
+        """ row of the template, an empty one is booked if needed """
+        if name not in self.index:
+            if len(self) == self.sumw.shape[0]:
+                self._grow(max(2 * len(self), 1))
+            self.index[name] = len(self)
+            self.names.append(name)
+        return self.index[name]
+
+    def add(self, name, sumw, sumw2):
+        irow = self.row_index(name)
+        self.sumw [irow] += sumw
+        self.sumw2[irow] += sumw2
+        return irow
+
+    def set(self, name, sumw, sumw2):
+        irow = self.row_index(name)
+        self.sumw [irow] = sumw
+        self.sumw2[irow] = sumw2
+        return irow
+
+    def get(self, name):
+        return Template(self, self.index[name], name)
+
+    def items(self):
+        for name in self.names:
+            yield name, self.get(name)
+
+    def compact(self):
+        """ drop the rows booked in advance but never used """
+        if self.sumw.shape[0] != len(self):
+            self._grow(len(self))
+        return self
@@ -0,0 +1,102 @@
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+from . import staging
+
+# bump this whenever the layout of the stored payload changes
+CACHE_VERSION = 5
+
+
+def default_dir():
+    """ where the scripts without an output directory keep their indices """
+    return os.environ.get(
+        "FTOOL_CACHEDIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "ftool")
+    )
+
+
+def fingerprint(fn):
+    """ identify an input file by its path, size and modification time """
+    st = os.stat(fn)
+    return [os.path.abspath(fn), st.st_size, st.st_mtime_ns]
+
+
+def digest(*payload):
+    blob = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()
+
+
+def load(path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def dump(path, payload):
+    # write to a temporary file first so that concurrent jobs
+    # never read a half written cache entry
+    dirname = os.path.dirname(path) or "."
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+class FileIndex(object):
+    """
+    values derived from input files, read once and kept on disk with one
+    small entry per input file under path. Entries are keyed by path and
+    dropped as soon as the size or the modification time of the file
+    changes. Without a path the index only lives in memory
+    """
+    version = 1
+    # the indices opened with shared(), by class and path
+    _shared = {}
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+
+    @classmethod
+    def shared(cls, path=None):
+        """ one index of this class per path for the whole process """
+        if (cls, path) not in FileIndex._shared:
+            FileIndex._shared[cls, path] = cls(path)
+        return FileIndex._shared[cls, path]
+
+    def entry_file(self, key):
+        return os.path.join(self.path, digest(key) + ".pkl")
+
+    def entry(self, fn):
+        key, size, mtime = fingerprint(fn)
+        entry = self.entries.get(key)
+        if entry is None and self.path is not None:
+            entry = load(self.entry_file(key))
+            if entry is not None and entry.get("version") != self.version:
+                entry = None
+        if entry is None or entry["stat"] != [size, mtime]:
+            entry = {"version": self.version, "stat": [size, mtime]}
+        self.entries[key] = entry
+        return key, entry
+
+    def lookup(self, fn, field, compute, ufile=None):
+        key, entry = self.entry(fn)
+        if field not in entry:
+            if ufile is None:
+                import uproot
+                with uproot.open(staging.path(fn)) as ufile:
+                    entry.update(compute(ufile))
+            else:
+                entry.update(compute(ufile))
+            if self.path is not None:
+                dump(self.entry_file(key), entry)
+        return entry[field]
@@ -0,0 +1,305 @@
+import re
+import fnmatch
+
+# systematics whose columns hold numbers, the other keywords are handled apart
+_column_pdfs = ("lnN", "lnU", "gmM", "trG")
+
+
+class Datacard(object):
+    """
+    content of a text datacard, with the attributes of the Datacard of
+    combine so that both can be used by combineCards.py
+    """
+    def __init__(self):
+        self.bins = []
+        self.obs = {}
+        self.processes = []
+        self.signals = []
+        self.isSignal = {}
+        self.keyline = []
+        self.exp = {}
+        self.systs = []
+        self.shapeMap = {}
+        self.hasShapes = False
+        self.flatParamNuisances = {}
+        self.rateParams = {}
+        self.rateParamsOrder = set()
+        self.extArgs = {}
+        self.binParFlags = {}
+        self.groups = {}
+        self.discretes = []
+        self.nuisanceEditLines = []
+
+
+def float_to_string(value):
+    return ("%.10f" % value).rstrip("0").rstrip(".")
+
+
+def float_to_string_scientific(value, etype="g"):
+    return ("%" + etype) % value
+
+
+def is_vetoed(name, patterns):
+    return any(pattern and re.match(pattern, name) for pattern in patterns)
+
+
+def is_included(name, patterns):
+    if not patterns:
+        return True
+    return is_vetoed(name, patterns)
+
+
+def _is_number(field):
+    try:
+        int(field)
+        return True
+    except ValueError:
+        return False
+
+
+def _add_rate_param(card, name, channel, process, fields):
+    if len(fields) == 5:
+        entry = [[name, fields[4], 0], ""]
+    elif "[" in fields[5]:
+        entry = [[name, fields[4], 0], fields[5]]
+    else:
+        entry = [[name, fields[4], fields[5], 1], ""]
+    card.rateParams.setdefault("{}AND{}".format(channel, process), []).append(entry)
+    card.rateParamsOrder.add(name)
+
+
+def _add_rate_params(card, fields):
+    # the wildcards are matched against the bins and processes of the card
+    name, channel, process = fields[0], fields[2], fields[3]
+    if "*" in channel or "*" in process:
+        channels  = re.compile(channel.replace("+", r"\+").replace("*", ".*"))
+        processes = re.compile(process.replace("+", r"\+").replace("*", ".*"))
+        for b in card.exp:
+            for p in card.exp[b]:
+                if channels.match(b) and processes.match(p):
+                    _add_rate_param(card, name, b, p, fields)
+    else:
+        _add_rate_param(card, name, channel, process, fields)
+
+
+def parse(lines, bin=True, noJMax=False, allowNoSignal=False, allowNoBackground=False,
+          evaluateEdits=True, nuisancesToExclude=(), stat=False, verbose=0):
+    """
+    read a datacard one line at a time, lines is an open file or any
+    iterable of lines. Only the syntax written by ftool.datacard is
+    understood: shapes, observation, rates, lnN (symmetric or not) and
+    shape systematics, rateParam and autoMCStats
+    """
+    card = Datacard()
+    binline = None
+    columns = {}
+    nprocesses = -1
+    for number, line in enumerate(lines, 1):
+        fields = line.split()
+        if not fields or fields[0].startswith("#") or fields[0].startswith("-"):
+            continue
+        keyword = fields[0]
+
+        if keyword in ("imax", "kmax"):
+            continue
+        if keyword == "jmax":
+            nprocesses = int(fields[1]) + 1 if fields[1] != "*" else -1
+            continue
+        if keyword == "shapes":
+            if not bin:
+                raise ValueError("line {}: shapes need a binary output".format(number))
+            if len(fields) < 4:
+                raise ValueError("line {}: malformed shapes line".format(number))
+            card.shapeMap.setdefault(fields[2], {})[fields[1]] = fields[3:]
+            card.hasShapes = True
+            continue
+        if keyword in ("observation", "Observation"):
+            obs = [float(x) for x in fields[1:]]
+            if binline is None or len(binline) != len(obs):
+                raise ValueError("line {}: observation does not match the bins".format(number))
+            card.bins = binline
+            card.obs = dict(zip(binline, obs))
+            continue
+        if keyword == "bin":
+            if binline is None:
+                binline = fields[1:]
+                card.bins = binline
+            else:
+                columns["bin"] = fields[1:]
+            continue
+        if keyword == "process":
+            columns["id" if all(_is_number(x) for x in fields[1:]) else "process"] = fields[1:]
+            continue
+        if keyword == "rate":
+            rates = [float(x) for x in fields[1:]]
+            if not (len(columns.get("bin", [])) == len(columns.get("process", [])) ==
+                    len(columns.get("id", [])) == len(rates)):
+                raise ValueError("line {}: bin, process and rate lines do not match".format(number))
+            card.exp = dict((b, {}) for b in card.bins)
+            for b, p, i, rate in zip(columns["bin"], columns["process"], columns["id"], rates):
+                if p not in card.isSignal:
+                    card.processes.append(p)
+                    card.isSignal[p] = int(i) <= 0
+                    if card.isSignal[p]:
+                        card.signals.append(p)
+                card.exp.setdefault(b, {})[p] = rate
+                card.keyline.append((b, p, card.isSignal[p]))
+            if not noJMax and nprocesses != -1 and nprocesses != len(card.processes):
+                raise ValueError("line {}: jmax does not match the processes".format(number))
+            if not card.signals and not allowNoSignal:
+                raise ValueError("line {}: no signal process".format(number))
+            if len(card.signals) == len(card.processes) and not allowNoBackground:
+                raise ValueError("line {}: no background process".format(number))
+            continue
+
+        if len(fields) < 2:
+            raise ValueError("line {}: cannot parse {}".format(number, line.strip()))
+        name, pdf = fields[0], fields[1]
+
+        if pdf == "rateParam":
+            if len(fields) not in (5, 6):
+                raise ValueError("line {}: malformed rateParam".format(number))
+            _add_rate_params(card, fields)
+            continue
+        if pdf == "autoMCStats":
+            if len(fields) > 5:
+                raise ValueError("line {}: malformed autoMCStats".format(number))
+            flags = [float(fields[2])]
+            if len(fields) > 3:
+                flags.append(bool(int(fields[3])))
+            if len(fields) > 4:
+                flags.append(int(fields[4]))
+            for b in fnmatch.filter(card.bins, name) or [name]:
+                card.binParFlags[b] = flags
+            continue
+        if pdf not in _column_pdfs and not pdf.startswith("shape"):
+            raise ValueError(
+                "line {}: {} is not understood by the native parser".format(number, pdf)
+            )
+
+        nofloat = name.endswith("[nofloat]")
+        name = name.replace("[nofloat]", "")
+        if stat:
+            continue
+        if nuisancesToExclude and is_vetoed(name, nuisancesToExclude):
+            continue
+        numbers = fields[2:]
+        if len(numbers) < len(card.keyline):
+            raise ValueError("line {}: {} has too few columns".format(number, name))
+        errline = dict((b, {}) for b in card.bins)
+        filled = 0
+        for (b, p, s), value in zip(card.keyline, numbers):
+            if "/" in value:
+                if pdf not in ("lnN", "lnU") and "?" not in pdf:
+                    raise ValueError("line {}: asymmetric {} for {}".format(number, pdf, name))
+                errline[b][p] = [float(x) for x in value.split("/")]
+            elif value == "-" * len(value):
+                errline[b][p] = 0.0
+            else:
+                errline[b][p] = float(value)
+            if errline[b][p] != 0:
+                filled += 1
+        if filled == 0:
+            continue
+        card.systs.append([name, nofloat, pdf, [], errline])
+    return card
+
+
+def dumps(card):
+    """ the text of a datacard, laid out like the ones of ftool.datacard """
+    lines = [
+        "imax * number of categories",
+        "jmax * number of samples minus one",
+        "kmax * number of nuisance parameters",
+        "-" * 30,
+    ]
+    for channel, shapes in card.shapeMap.items():
+        for process, stuff in shapes.items():
+            lines.append("shapes {} {} {}".format(process, channel, " ".join(stuff)))
+    lines.append("bin          " + "".join("{:>15}".format(b) for b in card.bins))
+    lines.append("observation  " + "".join(
+        "{:>15}".format(float_to_string(card.obs[b])) for b in card.bins if b in card.obs
+    ))
+    lines.append("-" * 30)
+    ids = {}
+    for p in card.processes:
+        ids[p] = len([x for x in ids if card.isSignal[x] == card.isSignal[p]])
+    nsignals = len(card.signals)
+    lines.append("{0:<8}".format("bin") + "".join("{0:>15}".format(b) for b, p, s in card.keyline))
+    lines.append("{0:<8}".format("process") + "".join("{0:>15}".format(p) for b, p, s in card.keyline))
+    lines.append("{0:<8}".format("process") + "".join(
+        "{0:>15}".format(ids[p] - nsignals + 1 if s else ids[p] + 1) for b, p, s in card.keyline
+    ))
+    lines.append("{0:<8}".format("rate") + "".join(
+        "{0:>15}".format("%.3f" % card.exp[b][p]) for b, p, s in card.keyline
+    ))
+    lines.append("-" * 30)
+    for name, nofloat, pdf, args, errline in card.systs:
+        cells = []
+        for b, p, s in card.keyline:
+            value = errline[b].get(p, 0)
+            if isinstance(value, list):
+                cells.append("/".join("%.3f" % v for v in value))
+            else:
+                cells.append("%.3f" % value if value != 0 else "-")
+        label = "{:<20} {}".format(name + ("[nofloat]" if nofloat else ""), pdf)
+        lines.append("{0:<8}".format(label) + "".join("{0:>15}".format(c) for c in cells))
+    for key, entries in card.rateParams.items():
+        channel, process = key.split("AND")
+        for entry in entries:
+            lines.append(" ".join(
+                [entry[0][0], "rateParam", channel, process] + [str(x) for x in entry[0][1:-1]] +
+                ([entry[1]] if entry[1] else [])
+            ))
+    for b, flags in card.binParFlags.items():
+        lines.append("{} autoMCStats {}".format(b, " ".join("%g" % f for f in flags)))
+    return "\n".join(lines)
+
+
+def from_datacard(datacard):
+    """
+    content of an ftool.datacard straight from memory, as parse would
+    read it back from the dumped card: the rates and the nuisances keep
+    the three decimals the card is written with
+    """
+    card = Datacard()
+    channel = datacard.channel
+    card.bins = [channel]
+    if datacard.observed is not None:
+        card.obs[channel] = float(datacard.observed)
+    card.shapeMap = {b: dict(shapes) for b, shapes in datacard.shape_map.items()}
+    card.hasShapes = bool(card.shapeMap)
+    card.exp[channel] = {}
+    for i, (process, rate) in enumerate(datacard.rates):
+        if process not in card.isSignal:
+            card.processes.append(process)
+            card.isSignal[process] = i < datacard.nsignal
+            if card.isSignal[process]:
+                card.signals.append(process)
+        card.exp[channel][process] = round(float(rate), 3)
+        card.keyline.append((channel, process, card.isSignal[process]))
+
+    for name in sorted(datacard.nuisances):
+        errline = {channel: {}}
+        filled = 0
+        for process in card.processes:
+            value = datacard.nuisances.get(name, process)
+            if value is None:
+                value = 0.0
+            elif isinstance(value, tuple):
+                value = [round(float(v), 3) for v in value]
+            else:
+                value = round(float(value), 3)
+            errline[channel][process] = value
+            if value != 0:
+                filled += 1
+        if filled == 0:
+            continue
+        name, pdf = name.split()
+        card.systs.append([name, False, pdf, [], errline])
+
+    for fields in datacard.rate_params:
+        _add_rate_params(card, fields)
+    if datacard.auto_stat is not None:
+        card.binParFlags[channel] = list(datacard.auto_stat)
+    return card
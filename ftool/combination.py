@@ -0,0 +1,329 @@
+import os
+import functools
+import collections
+import io
+from .cardparser import is_vetoed, is_included, float_to_string, float_to_string_scientific
+
+
+class Combination(object):
+    """
+    datacards combined one after the other into a single card, the way
+    combineCards.py does it. Two combinations of consecutive cards merge
+    into the combination of all of them, so groups of cards can be
+    combined apart and put together at the end
+    """
+    def __init__(self, vetos=(), includes=(), force_shape=False):
+        self.vetos = list(vetos)
+        self.includes = list(includes)
+        self.force_shape = force_shape
+        self.obsline = []
+        self.obskeyline = []
+        self.keyline = []
+        self.expline = []
+        self.systlines = {}
+        self.shapeLines = []
+        self.paramSysts = {}
+        self.flatParamNuisances = {}
+        self.discreteNuisances = {}
+        self.groups = {}
+        self.rateParams = {}
+        self.rateParamsOrder = set()
+        self.extArgs = {}
+        self.binParFlags = {}
+        self.nuisanceEdits = []
+        self.cmax = 5  # column width
+        # the veto and include regexps are evaluated once per bin
+        self.selectedBins = {}
+
+    def __getstate__(self):
+        # the selection is cheap to evaluate again, no need to ship it around
+        state = dict(self.__dict__)
+        state["selectedBins"] = {}
+        return state
+
+    def is_selected(self, b_in):
+        if b_in not in self.selectedBins:
+            self.selectedBins[b_in] = not is_vetoed(b_in, self.vetos) and is_included(b_in, self.includes)
+        return self.selectedBins[b_in]
+
+    def add_systematic(self, lsyst, nofloat, pdf, pdfargs, systeffect, fname):
+        """ the effect of a systematic on some bins, reconciled with the bins already there """
+        if lsyst in self.systlines:
+            (otherpdf, otherargs, othereffect, othernofloat) = self.systlines[lsyst]
+            if otherpdf != pdf:
+                if pdf == "lnN" and otherpdf.startswith("shape"):
+                    if self.systlines[lsyst][0][-1] != "?":
+                        self.systlines[lsyst][0] += "?"
+                elif pdf.startswith("shape") and otherpdf == "lnN":
+                    if pdf[-1] != "?":
+                        pdf += "?"
+                    self.systlines[lsyst][0] = pdf
+                elif (pdf == otherpdf + "?") or (pdf + "?" == otherpdf):
+                    self.systlines[lsyst][0] = pdf.replace("?", "") + "?"
+                else:
+                    raise RuntimeError(
+                        "File %s defines systematic %s as using pdf %s, while a previous file defines it as using %s"
+                        % (fname, lsyst, pdf, otherpdf)
+                    )
+            elif pdf == "gmN" and int(pdfargs[0]) != int(otherargs[0]):
+                raise RuntimeError(
+                    "File %s defines systematic %s as using gamma with %s events in sideband, while a previous file has %s"
+                    % (fname, lsyst, pdfargs[0], otherargs[0])
+                )
+            othereffect.update(systeffect)
+        else:
+            pdfargs = [str(x) for x in pdfargs]
+            self.systlines[lsyst] = [pdf, pdfargs, systeffect, nofloat]
+
+    def add_param(self, lsyst, pdfargs):
+        if lsyst in self.paramSysts:
+            if self.paramSysts[lsyst] != pdfargs:
+                raise RuntimeError("Parameter uncerainty %s mismatch between cards." % lsyst)
+        else:
+            self.paramSysts[lsyst] = pdfargs
+
+    def add_discrete(self, K):
+        if K in self.discreteNuisances:
+            raise RuntimeError("Cannot currently correlate discrete nuisances across categories. Rename %s in one." % K)
+        self.discreteNuisances[K] = True
+
+    def add(self, label, fname, DC):
+        """ append the bins of the parsed card DC read from fname, renamed after label """
+        dirname = os.path.dirname(fname)
+        singlebin = len(DC.bins) == 1
+        if label == ".":
+            label = DC.bins[0] if singlebin else ""
+        elif not singlebin:
+            label += "_"
+        for b in DC.bins:
+            bout = label if singlebin else label + b
+            b_in = label if singlebin else b
+            if not self.is_selected(b_in):
+                continue
+            self.obskeyline.append(bout)
+            for (p, e) in DC.exp[b].items():  # so that we get only self.DC.processes contributing to this bin
+                if DC.isSignal[p] == False:
+                    continue
+                self.expline.append("%s" % float_to_string(e)) if (e == 0 or e > 1e-3) else self.expline.append(
+                    "%s" % float_to_string_scientific(e)
+                )
+                self.keyline.append((bout, p, DC.isSignal[p]))
+            for (p, e) in DC.exp[b].items():  # so that we get only self.DC.processes contributing to this bin
+                if DC.isSignal[p]:
+                    continue
+                self.expline.append("%s" % float_to_string(e)) if (e == 0 or e > 1e-3) else self.expline.append(
+                    "%s" % float_to_string_scientific(e)
+                )
+                self.keyline.append((bout, p, DC.isSignal[p]))
+        # systematics
+        for (lsyst, nofloat, pdf, pdfargs, errline) in DC.systs:
+            systeffect = {}
+            if pdf == "param":
+                self.add_param(lsyst, pdfargs)
+                continue
+            for b in DC.bins:
+                bout = label if singlebin else label + b
+                b_in = label if singlebin else b
+                if not self.is_selected(b_in):
+                    continue
+                if bout not in systeffect:
+                    systeffect[bout] = {}
+                for p in DC.exp[b].keys():  # so that we get only self.DC.processes contributing to this bin
+                    r = str(errline[b][p])
+                    if type(errline[b][p]) == list:
+                        r = "%s/%s" % (float_to_string(errline[b][p][0]), float_to_string(errline[b][p][1]))
+                    elif type in ("lnN", "gmM"):
+                        r = "%s" % float_to_string(errline[b][p])
+                    if errline[b][p] == 0:
+                        r = "-"
+                    if len(r) > self.cmax:
+                        self.cmax = len(r)  # get max col length, as it's more tricky to do it later with a map
+                    systeffect[bout][p] = r
+            self.add_systematic(lsyst, nofloat, pdf, pdfargs, systeffect, fname)
+        # flat params
+        for K in DC.flatParamNuisances.keys():
+            self.flatParamNuisances[K] = True
+        for K in DC.extArgs.keys():
+            self.extArgs[K] = DC.extArgs[K]
+        for K in DC.binParFlags.keys():
+            tbin = label if singlebin else label + K
+            self.binParFlags[tbin] = DC.binParFlags[K]
+        # rate params
+        for K in DC.rateParams.keys():
+            tbin, tproc = K.split("AND")[0], K.split("AND")[1]
+            b_in = tbin
+            tbin = label if singlebin else label + tbin
+            if not self.is_selected(b_in):
+                continue
+            nK = tbin + "AND" + tproc
+            self.rateParams[nK] = DC.rateParams[K]
+            self.rateParamsOrder.update(DC.rateParamsOrder)
+        # discrete nuisance
+        for K in DC.discretes:
+            self.add_discrete(K)
+        # put shapes, if available
+        if len(DC.shapeMap):
+            for b in DC.bins:
+                bout = label if singlebin else label + b
+                b_in = label if singlebin else b
+                if not self.is_selected(b_in):
+                    continue
+                p2sMap = DC.shapeMap[b] if b in DC.shapeMap else {}
+                p2sMapD = DC.shapeMap["*"] if "*" in DC.shapeMap else {}
+                for p, x in p2sMap.items():
+                    xrep = [xi.replace("$CHANNEL", b) for xi in x]
+                    if xrep[0] != "FAKE" and dirname != "":
+                        xrep[0] = dirname + "/" + xrep[0]
+                    self.shapeLines.append((p, bout, xrep))
+                for p, x in p2sMapD.items():
+                    if p in p2sMap:
+                        continue
+                    xrep = [xi.replace("$CHANNEL", b) for xi in x]
+                    if xrep[0] != "FAKE" and dirname != "":
+                        xrep[0] = dirname + "/" + xrep[0]
+                    self.shapeLines.append((p, bout, xrep))
+        elif self.force_shape:
+            for b in DC.bins:
+                bout = label if singlebin else label + b
+                self.shapeLines.append(("*", bout, ["FAKE"]))
+        # combine observations, but remove line if any of the datacards doesn't have it
+        if len(DC.obs) == 0:
+            self.obsline = None
+        elif self.obsline is not None:
+            for b in DC.bins:
+                b_in = label if singlebin else b
+                if not self.is_selected(b_in):
+                    continue
+                self.obsline.append(float_to_string(DC.obs[b]))
+        # get the groups - keep nuisances in a set so that they are never repetitions
+        for groupName, nuisanceNames in DC.groups.items():
+            self.groups.setdefault(groupName, set()).update(nuisanceNames)
+
+        # Finally report nuisance edits propagated to end of card
+        for editline in DC.nuisanceEditLines:
+            if len(editline) == 2:
+                self.nuisanceEdits.append("%s %s" % (editline[0], " ".join(editline[1])))
+            else:
+                tmp_chan = editline[2]
+                tmp_proc = editline[1]
+                if tmp_chan == "*":  # all channels
+                    tmp_chan = "%s(%s)" % (label, "|".join(c for c in DC.bins)) if len(DC.bins) > 1 else label
+                else:
+                    tmp_chan = label + tmp_chan
+                if tmp_proc == "*":
+                    tmp_proc = "(%s)" % ("|".join(p for p in DC.processes))
+                self.nuisanceEdits.append("%s %s %s %s" % (editline[0], tmp_proc, tmp_chan, " ".join(editline[3])))
+        return self
+
+    def merge(self, other):
+        """ append the cards of other, as if they had been added here one after the other """
+        self.obskeyline += other.obskeyline
+        self.keyline += other.keyline
+        self.expline += other.expline
+        self.shapeLines += other.shapeLines
+        self.nuisanceEdits += other.nuisanceEdits
+        self.cmax = max(self.cmax, other.cmax)
+        if self.obsline is not None:
+            self.obsline = None if other.obsline is None else self.obsline + other.obsline
+        for lsyst, (pdf, pdfargs, systeffect, nofloat) in other.systlines.items():
+            self.add_systematic(lsyst, nofloat, pdf, pdfargs, systeffect, "one of the merged cards")
+        for lsyst, pdfargs in other.paramSysts.items():
+            self.add_param(lsyst, pdfargs)
+        for K in other.discreteNuisances:
+            self.add_discrete(K)
+        self.flatParamNuisances.update(other.flatParamNuisances)
+        self.extArgs.update(other.extArgs)
+        self.binParFlags.update(other.binParFlags)
+        self.rateParams.update(other.rateParams)
+        self.rateParamsOrder.update(other.rateParamsOrder)
+        for groupName, nuisanceNames in other.groups.items():
+            self.groups.setdefault(groupName, set()).update(nuisanceNames)
+        return self
+
+    def format(self, inputs=(), extra=None):
+        """ the text of the combined card, inputs are named in its first line """
+        keyline = self.keyline
+        systlines = self.systlines
+        # ordered sets, the order of appearance sets the process ids
+        bins = collections.OrderedDict.fromkeys(b for (b, p, s) in keyline)
+        signals = collections.OrderedDict.fromkeys(p for (b, p, s) in keyline if s)
+        backgrounds = collections.OrderedDict.fromkeys(p for (b, p, s) in keyline if not s)
+
+        # everything is written at once at the end
+        output = io.StringIO()
+        write = functools.partial(print, file=output)
+
+        write("Combination of", "  ".join(inputs))
+        write("imax %d number of bins" % len(bins))
+        write("jmax %d number of processes minus 1" % (len(signals) + len(backgrounds) - 1))
+        write("kmax %d number of nuisance parameters" % (len(systlines) + len(self.paramSysts)))
+        write("-" * 130)
+
+        if self.shapeLines:
+            chmax = max([max(len(p), len(c)) for p, c, x in self.shapeLines])
+            cfmt = "%-" + str(chmax) + "s "
+            for (process, channel, stuff) in sorted(self.shapeLines):
+                write("shapes", cfmt % process, cfmt % channel, " ".join(stuff))
+            write("-" * 130)
+
+        cmax = self.cmax
+        if self.obsline:
+            cmax = max([cmax] + [len(l) for l in self.obskeyline] + [len(x) for x in self.obsline])
+            cfmt = "%-" + str(cmax) + "s"
+            write("bin         ", "  ".join([cfmt % x for x in self.obskeyline]))
+            write("observation ", "  ".join([cfmt % x for x in self.obsline]))
+
+        write("-" * 130)
+
+        signalIndex = dict((p, i - len(signals) + 1) for i, p in enumerate(signals))
+        backgroundIndex = dict((p, i + 1) for i, p in enumerate(backgrounds))
+        pidline = [signalIndex[p] if s else backgroundIndex[p] for (b, p, s) in keyline]
+        cmax = max([cmax] + [max(len(p), len(b)) for p, b, s in keyline] + [len(e) for e in self.expline])
+        hmax = max([10] + [len("%-12s[nofloat]  %s %s" % (l, p, a)) for l, (p, a, e, nf) in systlines.items()])
+        cfmt = "%-" + str(cmax) + "s"
+        hfmt = "%-" + str(hmax) + "s  "
+        write(hfmt % "bin", "  ".join([cfmt % p for p, b, s in keyline]))
+        write(hfmt % "process", "  ".join([cfmt % b for p, b, s in keyline]))
+        write(hfmt % "process", "  ".join([cfmt % x for x in pidline]))
+        write(hfmt % "rate", "  ".join([cfmt % x for x in self.expline]))
+
+        write("-" * 130)
+
+        for name in sorted(systlines.keys()):
+            (pdf, pdfargs, effect, nofloat) = systlines[name]
+            if nofloat:
+                name += "[nofloat]"
+            systline = [effect.get(b, {}).get(p, "-") for b, p, s in keyline]
+            write(hfmt % ("%-21s   %s  %s" % (name, pdf, " ".join(pdfargs))), "  ".join([cfmt % x for x in systline]))
+        for (pname, pargs) in self.paramSysts.items():
+            write("%-12s  param  %s" % (pname, " ".join(pargs)))
+
+        for pname in self.flatParamNuisances.keys():
+            write("%-12s  flatParam" % pname)
+        for pname, entries in self.rateParams.items():
+            for entry in entries:
+                write("%-12s  rateParam %s" % (entry[0][0], pname.replace("AND", " ")), end=" ")
+                for p in entry[0][1:-1]:
+                    write(p, end=" ")
+                write(entry[1], end=" ")
+                write("\n", end=" ")
+        for dname in self.discreteNuisances.keys():
+            write("%-12s  discrete" % dname)
+        for ext in self.extArgs.keys():
+            write("%s" % " ".join(self.extArgs[ext]))
+        for groupName, nuisanceNames in self.groups.items():
+            write("%s group = %s" % (groupName, " ".join(nuisanceNames)))
+        for bpf, flags in self.binParFlags.items():
+            if len(flags) == 1:
+                write("%s autoMCStats %g" % (bpf, flags[0]))
+            if len(flags) == 2:
+                write("%s autoMCStats %g %i" % (bpf, flags[0], flags[1]))
+            if len(flags) == 3:
+                write("%s autoMCStats %g %i %i" % (bpf, flags[0], flags[1], flags[2]))
+
+        for edit in set(self.nuisanceEdits):
+            write("nuisance edit ", edit)
+
+        if extra is not None:
+            write(extra)
+        return output.getvalue()
@@ -0,0 +1,131 @@
+import os
+import re
+import collections
+from . import cache
+
+# <observable>_<channel>[_sys_<systematic>Up/Down] once the file name is removed
+_pattern = re.compile(
+    r"^(?P<observable>[^_]+)_(?P<channel>[^_]+)"
+    r"(?:_sys_(?P<systematic>.+?)(?P<direction>Up|Down)?)?$"
+)
+
+# loose version, for the names selected on substrings
+_systematic = re.compile(r"_sys_(?P<systematic>.+?)(?P<direction>Up|Down)?(;\d+)?$")
+
+# long channel names in the files and their short version in the cards
+aliases = {
+    "catSignal-0jet": "cat0Jet",
+    "catSignal-1jet": "cat1Jet",
+}
+
+
+class TemplateKey(collections.namedtuple(
+        "TemplateKey", ["process", "observable", "channel", "systematic", "direction"])):
+    """
+    identifies a template, str() gives the name used in the shape files:
+    <process>_<observable>[_<channel>][_sys_<systematic><direction>]
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        parts = [self.process, self.observable]
+        if self.channel is not None:
+            parts.append(self.channel)
+        if self.systematic is not None:
+            parts += ["sys", self.systematic + (self.direction or "")]
+        return "_".join(parts)
+
+
+def rename(channel):
+    """ short name of a channel """
+    return next((short for long, short in aliases.items() if long in channel), channel)
+
+
+def default_path():
+    return os.path.join(cache.default_dir(), "keys")
+
+
+def parse(name, prefix):
+    """ fields of a histogram name, None when it does not follow the convention """
+    name = name.split(";")[0]
+    if not name.startswith(prefix + "_"):
+        return None
+    match = _pattern.match(name[len(prefix) + 1:])
+    return match.groupdict() if match else None
+
+
+def guess(name, observable, channel):
+    """ fields of a name outside the convention, from what was used to select it """
+    match = _systematic.search(name)
+    return {
+        "observable": observable,
+        "channel"   : channel,
+        "systematic": match.group("systematic") if match else None,
+        "direction" : match.group("direction") if match else None,
+    }
+
+
+def _read_keys(ufile, prefix):
+    keys  = []
+    table = {}
+    for slot, key in enumerate(ufile._keys):
+        name = key._fName + b";" + str(key._fCycle).encode("utf-8")
+        classname = key._fClassName.decode("utf-8")
+        fields = parse(name.decode("utf-8"), prefix)
+        keys.append((name, slot, classname, fields))
+        if fields is not None and classname.startswith("TH1"):
+            table.setdefault((fields["observable"], fields["channel"]), []).append(slot)
+    return {"keys": keys, "table": table}
+
+
+def read(ufile, key):
+    """ read the object behind an index entry without scanning the directory """
+    name, slot = key[0], key[1]
+    tkey = ufile._keys[slot] if slot < len(ufile._keys) else None
+    if tkey is None or tkey._fName + b";" + str(tkey._fCycle).encode("utf-8") != name:
+        return ufile[name]
+    return tkey.get()
+
+
+class KeyIndex(cache.FileIndex):
+    """
+    name, slot, class and parsed fields of every key of a file, with the
+    histograms grouped by (observable, channel)
+    """
+    # bump this whenever the content of an entry changes
+    version = 1
+
+    def _lookup(self, fn, field, ufile=None):
+        prefix = os.path.basename(fn).replace(".root", "")
+        return self.lookup(
+            fn, field, lambda ufile: _read_keys(ufile, prefix), ufile
+        )
+
+    def keys(self, fn, ufile=None):
+        return self._lookup(fn, "keys", ufile)
+
+    def names(self, fn, ufile=None):
+        return [key[0] for key in self.keys(fn, ufile)]
+
+    def select(self, fn, observable, channels, ufile=None):
+        """
+        the histograms of an observable in a set of channels, names
+        outside the naming convention are matched on substrings
+        """
+        keys  = self._lookup(fn, "keys" , ufile)
+        table = self._lookup(fn, "table", ufile)
+        selected = [
+            keys[slot] for channel in channels
+            for slot in table.get((observable, channel), [])
+        ]
+        selected += [
+            key for key in keys
+            if key[3] is None and key[2].startswith("TH1") and
+            observable in key[0].decode("utf-8") and
+            any(channel in key[0].decode("utf-8") for channel in channels)
+        ]
+        return selected
+
+
+# one shared index per path for the whole process
+open_index = KeyIndex.shared
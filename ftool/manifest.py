@@ -0,0 +1,64 @@
+import os
+import glob
+import json
+import hashlib
+import tempfile
+from . import cache
+
+
+def code_version(*scripts):
+    """ digest of the ftool sources and of the given scripts """
+    sha = hashlib.sha1()
+    sources = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "*.py")))
+    for fn in sources + list(scripts):
+        with open(fn, "rb") as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def dataset(name, inputs, xsections=None):
+    """ what a card needs to know about one of its datasets """
+    procs = [os.path.basename(fn).replace(".root", "") for fn in inputs[name]["files"]]
+    return {
+        "input"    : inputs[name],
+        "xsections": [xsections.get(proc) for proc in procs] if xsections else None,
+        "files"    : [cache.fingerprint(fn) for fn in inputs[name]["files"]],
+    }
+
+
+def path(card_file):
+    return os.path.splitext(card_file)[0] + ".manifest.json"
+
+
+def normalise(manifest):
+    # what the manifest looks like once read back from the disk
+    return json.loads(json.dumps(manifest, sort_keys=True, default=str))
+
+
+def uptodate(card_file, manifest):
+    """
+    the card and its shape file exist and were built from the same
+    inputs, configuration and code as described by manifest
+    """
+    shape_file = os.path.splitext(card_file)[0] + ".root"
+    if not (os.path.exists(card_file) and os.path.exists(shape_file)):
+        return False
+    try:
+        with open(path(card_file)) as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return previous == normalise(manifest)
+
+
+def write(card_file, manifest):
+    """ store the manifest next to the card, once the card is complete """
+    dirname = os.path.dirname(card_file) or "."
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(normalise(manifest), f, sort_keys=True, indent=1)
+        os.replace(tmp, path(card_file))
+    except Exception:
+        os.remove(tmp)
+        raise
@@ -1,65 +1,114 @@
 import numpy as np
-import uproot
 import uproot_methods
+import uproot_methods.classes.TH1
 
-def from_physt(histogram):
-    import physt.binnings
-    import physt.histogram1d
 
-    class TH1(uproot_methods.classes.TH1.Methods, list):
-        pass
+class TAxis(object):
+    def __init__(self, fNbins, fXmin, fXmax):
+        self._fNbins = fNbins
+        self._fXmin = fXmin
+        self._fXmax = fXmax
+
+
+class TH1(uproot_methods.classes.TH1.Methods):
+    """
+    TH1 backed by a numpy array (under and overflow included) instead
+    of one python float per bin, uproot writes it straight from the array
+    """
+    def __len__(self):
+        return self._allvalues.shape[0]
+
+    def __getitem__(self, index):
+        return self._allvalues[index]
+
+    def __iter__(self):
+        return iter(self._allvalues)
+
+    @property
+    def allvalues(self):
+        return self._allvalues
+
 
-    class TAxis(object):
-        def __init__(self, fNbins, fXmin, fXmax):
-            self._fNbins = fNbins
-            self._fXmin = fXmin
-            self._fXmax = fXmax
+def make_th1(edges, content, errors2, name=None, underflow=0, overflow=0,
+             variable=True, tsumwx=None, tsumwx2=None):
+    """
+    TH1 from the bin edges, contents and sum of squared weights, the
+    moments default to the ones of the bin centres
+    """
+    edges   = np.asarray(edges, dtype=np.float64)
+    content = np.asarray(content)
+    errors2 = np.asarray(errors2, dtype=np.float64)
 
     out = TH1.__new__(TH1)
+    out._fXaxis = TAxis(edges.shape[0] - 1, edges[0], edges[-1])
+    if variable:
+        out._fXaxis._fXbins = edges.astype(">f8")
+
+    out._fSumw2 = np.zeros(errors2.shape[0] + 2)
+    out._fSumw2[1:-1] = errors2
+
+    centers = (edges[:-1] + edges[1:]) / 2
+    out._fEntries = content.sum()   # is there a #entries independent of weights?
+    out._fTsumw = content.sum()
+    out._fTsumw2 = errors2.sum()
+    if tsumwx is None:
+        tsumwx = (content * centers).sum()
+    if tsumwx2 is None:
+        tsumwx2 = (content * centers**2).sum()
+    out._fTsumwx = tsumwx
+    out._fTsumwx2 = tsumwx2
+
+    if name is not None:
+        out._fTitle = name
+    else:
+        out._fTitle = b""
+
+    out._classname, _ = uproot_methods.classes.TH1._histtype(content)
+
+    out._allvalues = np.empty(content.shape[0] + 2, dtype=np.float64)
+    out._allvalues[1:-1] = content
+    out._allvalues[0] = underflow
+    out._allvalues[-1] = overflow
+
+    return out
+
+
+def from_physt(histogram):
+    import physt.binnings
 
     if isinstance(histogram.binning, physt.binnings.FixedWidthBinning):
-        out._fXaxis = TAxis(histogram.binning.bin_count,
-                            histogram.binning.first_edge,
-                            histogram.binning.last_edge)
+        variable = False
     elif isinstance(histogram.binning, physt.binnings.NumpyBinning):
-        out._fXaxis = TAxis(histogram.binning.bin_count,
-                            histogram.binning.first_edge,
-                            histogram.binning.last_edge)
-        out._fXaxis._fXbins = histogram.binning.numpy_bins.astype(">f8")
+        variable = True
     else:
         raise NotImplementedError(histogram.binning)
 
-    centers = histogram.bin_centers
     content = histogram.frequencies
-
-    out._fSumw2 = [0] + list(histogram.errors2) + [0]
-
+    errors2 = histogram.errors2
+    # physt only knows the moments when it kept the statistics
     mean = histogram.mean()
     variance = histogram.variance()
-    out._fEntries = content.sum()   # is there a #entries independent of weights?
-    out._fTsumw = content.sum()
-    out._fTsumw2 = histogram.errors2.sum()
-    if mean is None:
-        out._fTsumwx = (content * centers).sum()
-    else:
-        out._fTsumwx = mean * out._fTsumw
-    if mean is None or variance is None:
-        out._fTsumwx2 = (content * centers**2).sum()
-    else:
-        out._fTsumwx2 = (mean**2 + variance) * out._fTsumw2
+    tsumwx, tsumwx2 = None, None
+    if mean is not None:
+        tsumwx = mean * content.sum()
+        if variance is not None:
+            tsumwx2 = (mean**2 + variance) * errors2.sum()
 
-    if histogram.name is not None:
-        out._fTitle = histogram.name
-    else:
-        out._fTitle = b""
+    return make_th1(
+        histogram.numpy_bins, content, errors2, histogram.name,
+        histogram.underflow, histogram.overflow, variable, tsumwx, tsumwx2
+    )
 
-    out._classname, content = uproot_methods.classes.TH1._histtype(content)
 
-    valuesarray = np.empty(len(content) + 2, dtype=content.dtype)
-    valuesarray[1:-1] = content
-    valuesarray[0] = histogram.underflow
-    valuesarray[-1] = histogram.overflow
+def from_arrays(edges, content, errors2, name=None):
+    """ TH1 with variable binning from the bin edges, contents and sum of squared weights """
+    return make_th1(edges, content, errors2, name)
 
-    out.extend(valuesarray)
 
-    return out
\ No newline at end of file
+def from_template(template):
+    return from_arrays(
+        template.numpy_bins,
+        template.frequencies,
+        template.errors2,
+        str(template.name)
+    )
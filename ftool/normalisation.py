@@ -0,0 +1,46 @@
+import os
+from . import cache
+
+
+def default_path():
+    return os.path.join(cache.default_dir(), "normalisation")
+
+
+def _read_runs(ufile):
+    runs = ufile["Runs"]
+    return {
+        "genEventSumw" : float(runs.array("genEventSumw").sum()),
+        "genEventCount": float(runs.array("genEventCount").sum()),
+    }
+
+
+def _read_xsecscale(ufile):
+    xsecscale = ufile["Events"].array("xsecscale")
+    return {
+        "xsecscale": (float(xsecscale[0]), float(xsecscale.mean()))
+    }
+
+
+class NormalisationIndex(cache.FileIndex):
+    """
+    per file normalisation factors: sums of genEventSumw and
+    genEventCount, first and mean xsecscale
+    """
+    # bump this whenever the content of an entry changes
+    version = 1
+
+    def sumw(self, fn, ufile=None):
+        """ sum of the generator weights, from the Runs tree """
+        return self.lookup(fn, "genEventSumw", _read_runs, ufile)
+
+    def count(self, fn, ufile=None):
+        """ number of generated events, from the Runs tree """
+        return self.lookup(fn, "genEventCount", _read_runs, ufile)
+
+    def xsecscale(self, fn, ufile=None):
+        """ first and mean value of the xsecscale branch of the Events tree """
+        return self.lookup(fn, "xsecscale", _read_xsecscale, ufile)
+
+
+# one shared index per path for the whole process
+open_index = NormalisationIndex.shared
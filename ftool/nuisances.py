@@ -0,0 +1,174 @@
+import fnmatch
+import numpy as np
+
+
+def kind(name, value):
+    """ lnN, asymmetric (a down/up pair of lnN values) or the type in the name """
+    if isinstance(value, (tuple, list)):
+        return "asymmetric"
+    return name.split()[-1] if name.split() else "lnN"
+
+
+class NuisanceMatrix(object):
+    """
+    values of the nuisances of a card in a dense (nuisance, process, 2)
+    array, the last axis holds the down/up pair of the asymmetric lnN
+    (up is nan otherwise) and nan marks the processes not affected.
+    Rows are looked up by name, the kind of each row is kept aside
+    """
+    def __init__(self, capacity=64, processes=8):
+        self.names = []
+        self.kinds = []
+        self.index = {}
+        self.processes = []
+        self.columns = {}
+        self.values = np.full((capacity, processes, 2), np.nan)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def _grow(self, capacity, processes):
+        values = np.full((capacity, processes, 2), np.nan)
+        rows, columns = self.values.shape[:2]
+        values[:rows, :columns] = self.values
+        self.values = values
+
+    def row_index(self, name, kind="lnN"):
+        """ row of the nuisance, an empty one is booked if needed """
+        if name not in self.index:
+            if len(self) == self.values.shape[0]:
+                self._grow(max(2 * len(self), 1), self.values.shape[1])
+            self.index[name] = len(self)
+            self.names.append(name)
+            self.kinds.append(kind)
+        return self.index[name]
+
+    def column_index(self, process):
+        """ column of the process, booked if needed """
+        if process not in self.columns:
+            if len(self.processes) == self.values.shape[1]:
+                self._grow(self.values.shape[0], max(2 * len(self.processes), 1))
+            self.columns[process] = len(self.processes)
+            self.processes.append(process)
+        return self.columns[process]
+
+    def rename(self, name, new):
+        """ move the values of a row to another one, merged if it exists """
+        irow = self.index.pop(name)
+        if new not in self.index:
+            self.names[irow] = new
+            self.kinds[irow] = kind(new, None)
+            self.index[new] = irow
+            return irow
+        target = self.index[new]
+        filled = ~np.isnan(self.values[irow, :, 0])
+        self.values[target, filled] = self.values[irow, filled]
+        # the last row takes the place of the removed one
+        last = len(self) - 1
+        if irow != last:
+            self.values[irow] = self.values[last]
+            self.names[irow] = self.names[last]
+            self.kinds[irow] = self.kinds[last]
+            self.index[self.names[irow]] = irow
+        self.values[last] = np.nan
+        self.names.pop()
+        self.kinds.pop()
+        return target
+
+    def set(self, name, process, value):
+        irow = self.row_index(name, kind(name, value))
+        icol = self.column_index(process)
+        if isinstance(value, (tuple, list)):
+            self.values[irow, icol] = value
+        else:
+            self.values[irow, icol] = (value, np.nan)
+        return irow
+
+    def get(self, name, process):
+        """ value of a nuisance for a process, None when it is not affected """
+        if name not in self.index or process not in self.columns:
+            return None
+        down, up = self.values[self.index[name], self.columns[process]]
+        if np.isnan(down):
+            return None
+        return down if np.isnan(up) else (down, up)
+
+    def format(self, processes, label_width=8, cell_width=15):
+        """ the card lines of the nuisances sorted by name, one column per process """
+        if not len(self):
+            return []
+        order = sorted(range(len(self)), key=self.names.__getitem__)
+        columns = [self.column_index(process) for process in processes]
+        values = self.values[order][:, columns]
+        down, up = values[..., 0], values[..., 1]
+
+        # one % for all the filled cells, then a single format per line
+        filled = ~np.isnan(down)
+        cells = np.full(down.shape, "-", dtype=object)
+        cells[filled] = ("%.3f " * filled.sum() % tuple(down[filled].tolist())).split()
+        asymmetric = ~np.isnan(up)
+        cells[asymmetric] = [
+            "%.3f/%.3f" % pair for pair in zip(down[asymmetric], up[asymmetric])
+        ]
+
+        line = "%-{}s".format(label_width) + "%{}s".format(cell_width) * len(columns)
+        return [
+            line % ((self.names[irow],) + tuple(row))
+            for irow, row in zip(order, cells.tolist())
+        ]
+
+
+class Pruning(object):
+    """
+    shape nuisances too small to matter: dropped when no bin moves by more
+    than threshold relative to the nominal (only the integral is checked
+    with integral=True), turned into a lnN when every bin moves like the
+    integral within flat. The nuisances matching one of the keep patterns
+    are left alone
+    """
+    def __init__(self, threshold=1e-3, integral=False, flat=None, keep=()):
+        self.threshold = threshold
+        self.integral  = integral
+        self.flat      = threshold if flat is None else flat
+        self.keep      = list(keep)
+
+    def keeps(self, name):
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in self.keep)
+
+    def decide(self, names, nominal, sumw):
+        """
+        for (nuisance, up/down, bin) variations of nominal: which ones to
+        drop, which ones to turn into a lnN, their (down, up) kappas and
+        their largest relative deviation
+        """
+        nominal = np.asarray(nominal, dtype=np.float64)
+        sumw = np.asarray(sumw, dtype=np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            relative = np.where(
+                nominal != 0, sumw / nominal - 1,
+                np.where(sumw == nominal, 0, np.inf)
+            )
+            integral = sumw.sum(axis=2) / nominal.sum() - 1
+            # empty nominal bins (e.g. the gaps of unrolled templates) do not
+            # tell the shape apart, unless the variation fills them
+            spread = np.where(
+                nominal != 0, np.abs(relative - integral[..., None]),
+                np.where(sumw == 0, 0, np.inf)
+            ).max(axis=(1, 2))
+        integral[~np.isfinite(integral)] = np.inf
+        if self.integral:
+            deviation = np.abs(integral).max(axis=1)
+        else:
+            deviation = np.abs(relative).max(axis=(1, 2))
+
+        kept = np.array([self.keeps(name) for name in names], dtype=bool)
+        drop = (deviation < self.threshold) & ~kept
+        flat = (spread < self.flat) & ~drop & ~kept
+        kappas = 1 + integral[:, ::-1]
+        return drop, flat, kappas, deviation
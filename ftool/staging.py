@@ -0,0 +1,193 @@
+import os
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+import concurrent.futures
+
+
+class Stage(object):
+    """
+    local copies of the input files living on a remote filesystem. A copy
+    is named after the source path, size and modification time, so a
+    changed source is fetched again. The modification time of a copy is
+    its last use: once the stage holds more than maxsize bytes the least
+    recently used copies are removed. Every process holds a shared flock
+    on the copies it uses until close(), so jobs sharing the stage never
+    evict a copy another one is about to read
+    """
+    def __init__(self, cachedir, maxsize=None, prefixes=("/eos/",), workers=2):
+        self.cachedir = cachedir
+        self.maxsize  = maxsize
+        self.prefixes = tuple(os.path.abspath(p) for p in prefixes)
+        self._lock = threading.Lock()
+        self._fetching = {}
+        self._leases = {}
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def remote(self, fn):
+        fn = os.path.abspath(fn)
+        return any(fn == p or fn.startswith(p.rstrip("/") + "/") for p in self.prefixes)
+
+    def local_path(self, fn):
+        st = os.stat(fn)
+        blob = "{}:{}:{}".format(os.path.abspath(fn), st.st_size, st.st_mtime_ns)
+        key = hashlib.sha1(blob.encode("utf-8")).hexdigest()
+        return os.path.join(self.cachedir, key[:2], key + "-" + os.path.basename(fn))
+
+    def lease(self, local, fd):
+        # the shared lock lives as long as fd, a previous lease is released
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        with self._lock:
+            previous = self._leases.pop(local, None)
+            self._leases[local] = fd
+        if previous is not None:
+            os.close(previous)
+
+    def reuse(self, fn, local):
+        """ lease the copy of fn already on the stage, False when there is none """
+        try:
+            fd = os.open(local, os.O_RDONLY)
+        except OSError:
+            return False
+        # the copy may have been evicted between the open and the lock
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        try:
+            valid = (
+                os.stat(local).st_ino == os.fstat(fd).st_ino and
+                os.fstat(fd).st_size == os.stat(fn).st_size
+            )
+        except OSError:
+            valid = False
+        if not valid:
+            os.close(fd)
+            return False
+        self.lease(local, fd)
+        os.utime(local)
+        return True
+
+    def fetch(self, fn):
+        """ copy fn to the stage unless a valid copy is already there """
+        local = self.local_path(fn)
+        if self.reuse(fn, local):
+            return local
+        dirname = os.path.dirname(local)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        try:
+            # leased before the rename, the copy is never visible unlocked
+            self.lease(local, fd)
+            shutil.copyfile(fn, tmp)
+            os.replace(tmp, local)
+        except Exception:
+            self.release(local)
+            os.remove(tmp)
+            raise
+        self.evict()
+        return local
+
+    def release(self, local):
+        with self._lock:
+            fd = self._leases.pop(local, None)
+        if fd is not None:
+            os.close(fd)
+
+    def evict(self):
+        if self.maxsize is None:
+            return
+        copies = []
+        for root, _, names in os.walk(self.cachedir):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                copies.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in copies)
+        for _, size, path in sorted(copies):
+            if total <= self.maxsize:
+                break
+            if path in self._leases:
+                continue
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                # a copy leased by any job is left alone
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+    def prefetch(self, files):
+        """ start copying the remote files in the background """
+        with self._lock:
+            for fn in files:
+                if self.remote(fn) and fn not in self._fetching:
+                    self._fetching[fn] = self._pool.submit(self.fetch, fn)
+
+    def path(self, fn):
+        """ the local copy of a remote file, fn itself otherwise """
+        if not self.remote(fn):
+            return fn
+        with self._lock:
+            future = self._fetching.pop(fn, None)
+        if future is not None:
+            return future.result()
+        return self.fetch(fn)
+
+    def close(self):
+        """ drop the prefetches that did not start yet and release the copies """
+        with self._lock:
+            for future in self._fetching.values():
+                future.cancel()
+            self._fetching = {}
+        for local in list(self._leases):
+            self.release(local)
+
+
+_stage = None
+
+
+def configure(cachedir=None, maxsize=None, prefixes=None):
+    """
+    enable the staging of the input files, the defaults come from the
+    FTOOL_STAGEDIR, FTOOL_STAGESIZE (in GB) and FTOOL_STAGEPREFIX
+    (colon separated) environment variables. Without a directory
+    the files are read in place
+    """
+    global _stage
+    if _stage is not None:
+        _stage.close()
+    cachedir = cachedir or os.environ.get("FTOOL_STAGEDIR")
+    if maxsize is None and os.environ.get("FTOOL_STAGESIZE"):
+        maxsize = float(os.environ["FTOOL_STAGESIZE"]) * 1024**3
+    if prefixes is None:
+        prefixes = os.environ.get("FTOOL_STAGEPREFIX", "/eos/").split(":")
+    _stage = Stage(cachedir, maxsize, prefixes) if cachedir else None
+    return _stage
+
+
+def path(fn):
+    return _stage.path(fn) if _stage is not None else fn
+
+
+def prefetch(files):
+    if _stage is not None:
+        _stage.prefetch(files)
+
+
+def close():
+    if _stage is not None:
+        _stage.close()
+
+
+configure()
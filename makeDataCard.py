@@ -2,6 +2,7 @@ import yaml
 import uproot
 import os
 import argparse
+import fnmatch
 import ftool
 import numpy as np
 from termcolor import colored
@@ -24,6 +25,7 @@ def main():
     parser.add_argument("-v"  , "--variable", type=str, default="measMET")
     parser.add_argument("-o"  , "--outdir"  , type=str, default="fitroom")
     parser.add_argument("-c"  , "--channel" , nargs='+', type=str)
+    parser.add_argument("-r"  , "--regions" , type=str, default=None)
     parser.add_argument("-s"  , "--signal"  , nargs='+', type=str)
     parser.add_argument("-t"  , "--stack"   , nargs='+', type=str)
     parser.add_argument("-era", "--era"     , type=str, default="2017")
@@ -33,19 +35,37 @@ def main():
     parser.add_argument("--rebin" ,type=int, default=1)
     parser.add_argument("-xs" , "--xsection", type=str, default="config/xsections_ERA.yaml")
     parser.add_argument("--onexsec", action="store_true")
+    parser.add_argument("--cachedir", type=str, default=None)
+    parser.add_argument("--nocache", action="store_true")
+    parser.add_argument("-j"  , "--jobs"    , type=int, default=1)
+    parser.add_argument("--lazy", action="store_true")
+    parser.add_argument("--repair", type=str, default="zero", choices=["zero", "epsilon", "renormalise"])
+    parser.add_argument("--lowmem", action="store_true")
+    parser.add_argument("--float32", action="store_true")
+    parser.add_argument("--stagedir", type=str, default=None)
+    parser.add_argument("--stagesize", type=float, default=None)
+    parser.add_argument("--stageprefix", nargs='+', type=str, default=None)
+    parser.add_argument("--compression", type=str, default="zlib:1")
+    parser.add_argument("--prune", type=float, default=None)
+    parser.add_argument("--prune-integral", action="store_true")
+    parser.add_argument("--prune-flat", type=float, default=None)
+    parser.add_argument("--prune-keep", nargs='+', type=str, default=[])
+    parser.add_argument("--combine", type=str, default=None)
 
     options = parser.parse_args()
+    try:
+        ftool.compression(options.compression)
+    except ValueError as error:
+        parser.error(str(error))
     
     print("range =", options.binrange)
     # create a working directory where to store the datacards
     try:
         os.mkdir(options.outdir)
         print("Directory " , options.outdir ,  " Created ")
-    except:
-        if options.force:
-            os.rmdir(options.outdir)
-            os.mkdir(options.outdir)
-            print("Directory " , options.outdir ,  " Re-created ")
+    except OSError:
+        # the directory is kept, --force rebuilds the cards that are up to date
+        pass
 
     inputs = None
     with open(options.input) as f:
@@ -64,41 +84,209 @@ def main():
     if options.onexsec:
         xsections = { s: {'br': 1.0, 'kr': 1.0, 'xsec': 1.0} for s, xs in xsections.items()}
 
-    if len(options.channel) == 1:
-        options.channel = options.channel[0]
+    # every region ends up in its own card, they are all filled
+    # from a single read of each input file
+    regions = {
+        "default": {
+            "channel" : options.channel,
+            "rebin"   : options.rebin,
+            "binrange": options.binrange
+        }
+    }
+    if options.regions:
+        with open(options.regions) as f:
+            try:
+                regions = yaml.safe_load(f.read())
+            except yaml.YAMLError as exc:
+                print (exc)
+    for label, region in regions.items():
+        region.setdefault("variable", options.variable)
+        region.setdefault("rebin"   , options.rebin)
+        region.setdefault("binrange", options.binrange)
+        if isinstance(region["channel"], list) and len(region["channel"]) == 1:
+            region["channel"] = region["channel"][0]
+
+    # processed backgrounds are shared between all the signal points
+    cachedir = None
+    if not options.nocache:
+        cachedir = options.cachedir or os.path.join(options.outdir, ".cache")
+
+    # the signal points come either from the stack or from the
+    # patterns given to --signal, the rest is built only once
+    signals = [dg for dg in options.stack if inputs[dg]["type"] == "signal"]
+    if options.signal:
+        signals += [
+            n for n, sam in inputs.items()
+            if sam["type"] == "signal" and n not in signals and
+            any(fnmatch.fnmatch(n, pattern) for pattern in options.signal)
+        ]
 
-    # make datasets per prcess
-    datasets = {}
-    nsignals = 0
-    signal = ""
+    # a card is rebuilt only when its inputs, configuration or the code
+    # changed since the manifest next to it was written, unless forced
+    code_version = ftool.manifest.code_version(os.path.abspath(__file__))
+    manifests = {}
+    todo = {}
+    for signal in (signals or [None]):
+        todo[signal] = []
+        for label, region in regions.items():
+            card_file = ftool.datacard.card_file(
+                signal or "", card_channel(region["channel"], options.era)
+            )
+            manifests[card_file] = make_manifest(
+                signal, region, inputs, xsections, signals, options, code_version
+            )
+            if options.force or not ftool.manifest.uptodate(card_file, manifests[card_file]):
+                todo[signal].append(label)
+            else:
+                print(colored(" -- {} is up to date".format(card_file), "blue"))
+    if not any(todo.values()):
+        combine_regions(signals, regions, {}, options)
+        return
+
+    # remote inputs are copied to a local stage while the cards are built
+    ftool.staging.configure(
+        options.stagedir,
+        options.stagesize * 1024**3 if options.stagesize else None,
+        options.stageprefix
+    )
+    ftool.staging.prefetch([
+        fn for dg in options.stack + signals for fn in inputs[dg]["files"]
+        if dg not in signals or todo[dg]
+    ])
+
+    # only the regions of the cards to rebuild are read
+    stale = {
+        label: region for label, region in regions.items()
+        if any(label in labels for labels in todo.values())
+    }
+    backgrounds = {label: {} for label in stale}
     for dg in options.stack:
-        p = ftool.datagroup(
-            inputs[dg]["files"],
-            ptype      = inputs[dg]["type"],
-            observable = options.variable,
-            name       = dg,
-            kfactor    = inputs[dg].get("kfactor", 1.0),
-            xsections  = xsections,
-            channel    = options.channel,
-            rebin      = options.rebin,
-            binrange   = options.binrange,
-            luminosity = lumis[options.era]
-        )
-        #p.save()
-        datasets[p.name] = p
-        if p.ptype == "signal":
-            signal = p.name
-
-    card_name = "ch"+options.era
-    if isinstance(options.channel, str):
-        card_name = options.channel+options.era
-    elif isinstance(options.channel, list):
-        if np.all(["signal" in c.lower() for c in options.channel]):
-            card_name = "chBSM"+options.era
+        if dg in signals:
+            continue
+        groups = make_datagroups(dg, inputs, xsections, stale, options, cachedir)
+        for label, p in groups.items():
+            backgrounds[label][p.name] = p
+
+    built = {}
+    for signal in (signals or [None]):
+        if not todo[signal]:
+            continue
+        groups = {}
+        if signal is not None:
+            print(colored(" -- signal : " + signal, "green"))
+            groups = make_datagroups(
+                signal, inputs, xsections,
+                {label: regions[label] for label in todo[signal]}, options, cachedir
+            )
+        for label in todo[signal]:
+            region = regions[label]
+            datasets = {}
+            if signal is not None:
+                datasets[signal] = groups[label]
+            datasets.update(backgrounds[label])
+            card = make_card(signal or "", datasets, region["channel"], options)
+            ftool.manifest.write(card.dc_name, manifests[card.dc_name])
+            if options.combine is not None:
+                built[signal, label] = card
+        print_repairs(groups.values())
+    for label in stale:
+        print_repairs(backgrounds[label].values())
+    ftool.staging.close()
+    print(" -- peak RSS of the process {:8.1f} MB".format(ftool.peak_rss()))
+    combine_regions(signals, regions, built, options)
+
+
+def make_datagroups(dg, inputs, xsections, regions, options, cachedir=None):
+    # all the regions of a dataset are read together, their peak is the
+    # high-water mark of the process while they are loaded
+    reset = ftool.reset_peak_rss()
+    groups = ftool.datagroup.multichannel(
+        inputs[dg]["files"],
+        {
+            label: {
+                "channel"   : region["channel"],
+                "observable": region["variable"],
+                "rebin"     : region["rebin"],
+                "binrange"  : region["binrange"]
+            } for label, region in regions.items()
+        },
+        ptype      = inputs[dg]["type"],
+        name       = dg,
+        kfactor    = inputs[dg].get("kfactor", 1.0),
+        xsections  = xsections,
+        luminosity = lumis[options.era],
+        cachedir   = cachedir,
+        workers    = options.jobs,
+        lazy       = options.lazy,
+        repair     = options.repair,
+        lowmem     = options.lowmem,
+        dtype      = np.float32 if options.float32 else np.float64
+    )
+    for label, p in groups.items():
+        print(" -- {:<10} {:<20} {:8.1f} MB in templates".format(dg, label, p.nbytes() / 1024.**2))
+    if reset:
+        print(" -- {:<10} {:<20} {:8.1f} MB peak RSS while loading".format(dg, "", ftool.peak_rss(since_reset=True)))
+    return groups
+
+
+def print_repairs(groups):
+    for p in groups:
+        for name, nbins in p.repair_report().items():
+            print(colored(" -- {:<50} {:>4} negative bins repaired".format(name, nbins), "yellow"))
+
+
+def card_channel(channel, era):
+    name = "ch"+era
+    if isinstance(channel, str):
+        name = channel+era
+    elif isinstance(channel, list):
+        if np.all(["signal" in c.lower() for c in channel]):
+            name = "chBSM"+era
+    return name
+
+
+# options that change how the cards are built, not what they contain
+build_options = [
+    "input", "xsection", "outdir", "force", "signal", "stack", "regions",
+    "cachedir", "nocache", "jobs", "lazy", "stagedir", "stagesize", "stageprefix",
+    "combine"
+]
+
+
+def make_manifest(signal, region, inputs, xsections, signals, options, code_version):
+    names = ([signal] if signal is not None else []) + [
+        dg for dg in options.stack if dg not in signals
+    ]
+    return {
+        "ftool"   : code_version,
+        "options" : {k: v for k, v in vars(options).items() if k not in build_options},
+        "region"  : region,
+        "datasets": [
+            [dg, ftool.manifest.dataset(dg, inputs, xsections if inputs[dg]["type"] != "data" else None)]
+            for dg in names
+        ],
+    }
+
+
+def make_pruning(options):
+    if options.prune is None:
+        return None
+    return ftool.nuisances.Pruning(
+        threshold = options.prune,
+        integral  = options.prune_integral,
+        flat      = options.prune_flat,
+        keep      = options.prune_keep
+    )
+
+
+def make_card(signal, datasets, channel, options):
+    card_name = card_channel(channel, options.era)
 
     card = ftool.datacard(
         name = signal,
-        channel= card_name
+        channel= card_name,
+        compression = ftool.compression(options.compression),
+        pruning = make_pruning(options)
     )
     card.shapes_headers()
 
@@ -118,20 +306,20 @@ def main():
         card.add_nuisance(name, "{:<21}  lnN".format("CMS_RES_e"),  1.005)
         card.add_nuisance(name, "{:<21}  lnN".format("CMS_RES_m"),  1.005)
         
-        card.add_shape_nuisance(name, "CMS_EFF_e", p.get("ElecronSF" ), symmetrise=True)
-        card.add_shape_nuisance(name, "CMS_EFF_m", p.get("MuonSF")    , symmetrise=True)
-       
-        card.add_shape_nuisance(name, "CMS_JES_{}".format(options.era), p.get("jesTotal") , symmetrise=False)
-        card.add_shape_nuisance(name, "CMS_JER_{}".format(options.era), p.get("jer")      , symmetrise=False)
-        
-        card.add_shape_nuisance(name, "CMS_BTag_{}".format(options.era), p.get("btagEventWeight"), symmetrise=False)
-        card.add_shape_nuisance(name, "CMS_Trig_{}".format(options.era), p.get("TriggerSFWeight"), symmetrise=True)
-        
+        shapes = [
+            ("CMS_EFF_e", p.get("ElecronSF" ), True),
+            ("CMS_EFF_m", p.get("MuonSF")    , True),
+            ("CMS_JES_{}".format(options.era), p.get("jesTotal") , False),
+            ("CMS_JER_{}".format(options.era), p.get("jer")      , False),
+            ("CMS_BTag_{}".format(options.era), p.get("btagEventWeight"), False),
+            ("CMS_Trig_{}".format(options.era), p.get("TriggerSFWeight"), True),
+        ]
         if options.era in ['2016','2017']:
-            card.add_shape_nuisance(name, "CMS_pfire_{}".format(options.era), p.get("PrefireWeight"))
-            
-        card.add_shape_nuisance(name, "CMS_Vx_{}".format(options.era), p.get("nvtxWeight"), symmetrise=False)
-        card.add_shape_nuisance(name, "CMS_PU_{}".format(options.era), p.get("puWeight"  ), symmetrise=False)
+            shapes.append(("CMS_pfire_{}".format(options.era), p.get("PrefireWeight"), False))
+        shapes += [
+            ("CMS_Vx_{}".format(options.era), p.get("nvtxWeight"), False),
+            ("CMS_PU_{}".format(options.era), p.get("puWeight"  ), False),
+        ]
         
         #QCD scale, PDF and other theory uncertainty
         if 'DY' not in name:
@@ -141,17 +329,19 @@ def main():
             )
         
         if options.era == '2016':
-            card.add_shape_nuisance(name, "PDF_2016", p.get("PDF"), symmetrise=True)
+            shapes.append(("PDF_2016", p.get("PDF"), True))
         else:
-            card.add_shape_nuisance(name, "PDF_1718", p.get("PDF"), symmetrise=True)
+            shapes.append(("PDF_1718", p.get("PDF"), True))
           
         card.add_nuisance(name, "{:<21}  lnN".format("UEPS"),  1.020) # Underlying events
         
         # EWK uncertainties
         if name in ["ZZ"]:
-            card.add_shape_nuisance(name, "EWKZZ", p.get("EWK"), symmetrise=True)
+            shapes.append(("EWKZZ", p.get("EWK"), True))
         if name in ["WZ"]:
-            card.add_shape_nuisance(name, "EWKWZ", p.get("EWK"), symmetrise=True)                          
+            shapes.append(("EWKWZ", p.get("EWK"), True))
+        # all the shape variations of the process are handled in one go
+        card.add_shape_nuisances(name, shapes)
         
         # define rates
         if name  in ["TOP", "WW"]:
@@ -175,6 +365,30 @@ def main():
         # adding statistical uncertainties
         card.add_auto_stat()
     card.dump()
+    for line in card.pruning_report():
+        print(colored(" -- {} pruned {}".format(card_name, line), "yellow"))
+    return card
+
+
+def combine_regions(signals, regions, built, options):
+    """
+    one card with all the regions of each signal, the cards built in this
+    run are combined from memory and the others read back from their files
+    """
+    if options.combine is None:
+        return
+    for signal in (signals or [None]):
+        cards = [
+            built.get((signal, label)) or ftool.datacard.card_file(
+                signal or "", card_channel(region["channel"], options.era)
+            )
+            for label, region in regions.items()
+        ]
+        filename = os.path.join(
+            os.path.dirname(ftool.datacard.card_file(signal or "", "")), options.combine
+        )
+        ftool.combine_cards(cards, filename)
+        print(colored(" -- combined card : " + filename, "green"))
 
 
 if __name__ == "__main__":
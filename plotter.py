@@ -9,6 +9,7 @@ import argparse
 import yaml
 import os
 import numpy as np
+from ftool import normalisation, keyindex, staging
 
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 ROOT.gROOT.SetBatch(ROOT.kTRUE)
@@ -29,6 +30,12 @@ xsections = {}
 with open("./config/xsections_{}.yaml".format(options.era), 'r') as stream:
     xsections = yaml.safe_load(stream)
 
+# genEventSumw sums and the key lists are read once per file and kept on disk
+norm = normalisation.open_index(normalisation.default_path())
+keys = keyindex.open_index(keyindex.default_path())
+# remote inputs are copied locally when FTOOL_STAGEDIR is set
+staging.prefetch([fn for cmd in processes.values() for fn in cmd["files"]])
+
 controlreg = ["catMM","catEE", "catEM", "cat3L", "cat4L", "DY"]
 
 error_band_color           = 138
@@ -424,11 +431,11 @@ def drawing(channel="_3L", ylog=True, lumi=41.5, blind=True, rebin=1):
         hist_objs = []
         dic_root_histos = {}
         for fn in files:
-            fn_root = uproot.open(fn)
-            bn_root = ROOT.TFile.Open(fn)
+            fn_root = uproot.open(staging.path(fn))
+            bn_root = ROOT.TFile.Open(staging.path(fn))
             hist_names = []
             syst_names = []
-            for nm in fn_root.keys():
+            for nm in keys.names(fn, fn_root):
                 if 'sys' in str(nm):
                     syst_names.append(nm)
                     continue
@@ -453,7 +460,7 @@ def drawing(channel="_3L", ylog=True, lumi=41.5, blind=True, rebin=1):
                     scale *= xsections[os.path.basename(fn.replace(".root", ""))]["kr"]
                     scale *= xsections[os.path.basename(fn.replace(".root", ""))]["br"]
                     scale *= 1000.0
-                    scale *= lumi/fn_root["Runs"].array("genEventSumw").sum()
+                    scale *= lumi/norm.sumw(fn, fn_root)
                     scale *= cmd.get("kfactor", 1.0)
                     hist.Sumw2()
                     hist.Scale(scale)
@@ -30,31 +30,15 @@ for year in [2016, 2017, 2018]:
     for n, sam in inputs.items():
         if "Pseudoscalar2HDM_mH-300_ma-100" not in n: continue
         print(" ===== processing : ", n, sam, year)
-        cmd_sr = "python3 makeDataCard.py --channel catSignal-0jet catSignal-1jet "
-        cmd_sr += "--variable MT " if "2HDM" in n else "" 
-        cmd_sr += "--stack {signal} ZZ WZ WW VVV TOP DY data "
-        cmd_sr += "--input=config/inputs-NanoAODv5-{era}.yaml --era={era}"
-        cmd_sr = cmd_sr.format(signal=n, era=year)
+        # signal and control regions are all written from a single
+        # read of the inputs, see config/regions.yaml
+        cmd = "python3 makeDataCard.py --regions config/regions.yaml "
+        cmd += "--variable MT " if "2HDM" in n else "" 
+        cmd += "--stack {signal} ZZ WZ WW VVV TOP DY data "
+        cmd += "--input=config/inputs-NanoAODv5-{era}.yaml --era={era}"
+        cmd = cmd.format(signal=n, era=year)
         
-        cmd_3l = "python3 makeDataCard.py --channel cat3L "
-        cmd_3l += "--stack {signal} ZZ WZ WW VVV TOP DY data --binrange 1 20 "
-        cmd_3l += "--input=config/inputs-NanoAODv5-{era}.yaml --era={era}"
-        cmd_3l = cmd_3l.format(signal=n, era=year)
-        
-        cmd_4l = "python3 makeDataCard.py --channel cat4L "
-        cmd_4l += "--stack {signal} ZZ WZ WW VVV TOP DY data --binrange 1 20 "
-        cmd_4l += "--input=config/inputs-NanoAODv5-{era}.yaml --era={era}"
-        cmd_4l = cmd_4l.format(signal=n, era=year)
-        
-        cmd_em = "python3 makeDataCard.py --channel catEM "
-        cmd_em += "--stack {signal} ZZ WZ WW VVV TOP DY data --binrange 1 20 --rebin=4 "
-        cmd_em += "--input=config/inputs-NanoAODv5-{era}.yaml --era={era}"
-        cmd_em = cmd_em.format(signal=n, era=year)
-        
-        results.append(pool.apply_async(call_makeDataCard, (cmd_sr,)))
-        results.append(pool.apply_async(call_makeDataCard, (cmd_3l,)))
-        results.append(pool.apply_async(call_makeDataCard, (cmd_4l,)))
-        results.append(pool.apply_async(call_makeDataCard, (cmd_em,)))
+        results.append(pool.apply_async(call_makeDataCard, (cmd,)))
 
 # Close the pool and wait for each running task to complete
 pool.close()
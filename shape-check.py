@@ -11,6 +11,7 @@ import math
 import yaml
 import os
 import numpy as np
+from ftool import normalisation, keyindex, staging
 
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 ROOT.gROOT.SetBatch(ROOT.kTRUE)
@@ -32,6 +33,12 @@ xsections = {}
 with open("./config/xsections_{}.yaml".format(2017), 'r') as stream:
     xsections = yaml.safe_load(stream)
 
+# genEventCount, xsecscale and the key lists are read once per file and kept on disk
+norm = normalisation.open_index(normalisation.default_path())
+keys = keyindex.open_index(keyindex.default_path())
+# remote inputs are copied locally when FTOOL_STAGEDIR is set
+staging.prefetch([fn for cmd in processes.values() for fn in cmd["files"]])
+
 error_band_color           = 138
 error_band_style           = 3357
 error_band_opacity         = 1
@@ -418,11 +425,11 @@ def drawing(channel="_3L", ylog=True, lumi=41.5, blind=True):
         hist_nom  = None
         root_histos_syst = {}
         for fn in files:
-            fn_root = uproot.open(fn)
-            bn_root = ROOT.TFile.Open(fn)
+            fn_root = uproot.open(staging.path(fn))
+            bn_root = ROOT.TFile.Open(staging.path(fn))
             hist_names = []
             syst_names = []
-            for nm in fn_root.keys():
+            for nm in keys.names(fn, fn_root):
                 if 'sys' in str(nm):
                     syst_names.append(str(nm.decode('UTF-8')))
                     continue
@@ -439,8 +446,9 @@ def drawing(channel="_3L", ylog=True, lumi=41.5, blind=True):
 
                 hist.SetDirectory(0)
                 if cmd.get("type") != "data":
-                    scale = lumi/fn_root["Runs"].array("genEventCount").sum()
-                    original_xsec = abs(fn_root["Events"].array("xsecscale")[0])
+                    scale = lumi/norm.count(fn, fn_root)
+                    first_xsec, mean_xsec = norm.xsecscale(fn, fn_root)
+                    original_xsec = abs(first_xsec)
                     xsec  = xsections[os.path.basename(fn.replace(".root", ""))]["xsec"]
                     xsec *= xsections[os.path.basename(fn.replace(".root", ""))]["kr"]
                     xsec *= xsections[os.path.basename(fn.replace(".root", ""))]["br"]
@@ -454,7 +462,7 @@ def drawing(channel="_3L", ylog=True, lumi=41.5, blind=True):
                     ))
 
                     scale *= xsec/original_xsec
-                    scale /= np.mean((1.0+fn_root["Events"].array("xsecscale")/original_xsec)/2.0)
+                    scale /= (1.0+mean_xsec/original_xsec)/2.0
                     scale *= cmd.get("kfactor", 1.0)
 
                     hist.Sumw2()